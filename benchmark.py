@@ -0,0 +1,316 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import string
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import PIL
+from PIL import Image, ImageFont
+
+# keep benchmark runs from reading or polluting the bot's own caches
+os.environ.setdefault("TT_CACHE_DIR", tempfile.mkdtemp(prefix="tt-bench-cache-"))
+
+from pilmoji.source import AppleEmojiSource
+from texting_theory import (
+    CHAIN_BADGE_SIZE,
+    CHAIN_SIDE_MARGIN,
+    CHAIN_TEXT_BADGE_GAP,
+    CHAIN_TEXT_SIZE,
+    CHAIN_WIDTH,
+    CONVO_MAX_BUBBLE_WIDTH,
+    CONVO_PAD,
+    Classification,
+    TextMessage,
+    conversation_font,
+    render_conversation,
+    render_reddit_chain,
+    wrap_text,
+    wrap_text_by_width,
+)
+
+EMOJI = ["😂", "😭", "🙏", "❤️", "🔥", "💀", "😍", "🥺", "👀", "✨", "🤡", "😳"]
+WORD_CHARS = string.ascii_lowercase
+
+
+@dataclass
+class Scenario:
+    name: str
+    messages: int
+    min_words: int
+    max_words: int
+    emoji_density: float
+    long_token_rate: float
+    unsent_rate: float
+
+
+SCENARIOS = [
+    Scenario("short", 6, 1, 10, 0.0, 0.0, 0.0),
+    Scenario("typical", 20, 1, 30, 0.05, 0.01, 0.05),
+    Scenario("long", 45, 5, 80, 0.05, 0.01, 0.05),
+    Scenario("emoji_heavy", 20, 1, 20, 0.4, 0.0, 0.0),
+    Scenario("long_tokens", 10, 1, 15, 0.0, 0.3, 0.1),
+]
+
+
+def generate_conversation(scenario: Scenario, seed: int, avatar_base: str):
+    rng = random.Random(seed)
+    classifications = [
+        c
+        for c in Classification
+        if c
+        not in (
+            Classification.CHECKMATED,
+            Classification.RESIGN,
+            Classification.ABANDON,
+            Classification.TIMEOUT,
+            Classification.DRAW,
+            Classification.WINNER,
+        )
+    ]
+    msgs = []
+    for i in range(scenario.messages):
+        words = []
+        for _ in range(rng.randint(scenario.min_words, scenario.max_words)):
+            roll = rng.random()
+            if roll < scenario.emoji_density:
+                words.append(rng.choice(EMOJI))
+            elif roll < scenario.emoji_density + scenario.long_token_rate:
+                words.append(
+                    "".join(rng.choice(WORD_CHARS) for _ in range(rng.randint(40, 160)))
+                )
+            else:
+                words.append(
+                    "".join(rng.choice(WORD_CHARS) for _ in range(rng.randint(1, 10)))
+                )
+        side = rng.choice(["left", "right"])
+        username = f"user-{side}"
+        msgs.append(
+            TextMessage(
+                side=side,
+                content=" ".join(words),
+                classification=rng.choice(classifications),
+                unsent=rng.random() < scenario.unsent_rate,
+                username=username,
+                avatar_url=f"{avatar_base}/avatar/{username}.png",
+            )
+        )
+    return msgs
+
+
+def _png_bytes(size, color):
+    buf = io.BytesIO()
+    Image.new("RGBA", (size, size), color).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    avatar_png = _png_bytes(256, "#ff4500")
+    emoji_png = _png_bytes(160, "#ffcc4d")
+
+    def do_GET(self):
+        body = self.emoji_png if self.path.startswith("/emoji/") else self.avatar_png
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def _rss_kib():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def peak_memory(fn):
+    # tracemalloc only sees the Python heap; Pillow allocates image buffers
+    # itself, so RSS is sampled alongside it where /proc is available.
+    baseline = _rss_kib()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            rss = _rss_kib()
+            if rss is not None and rss > peak[0]:
+                peak[0] = rss
+            done.wait(0.002)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    tracemalloc.start()
+    if baseline is not None:
+        sampler.start()
+    try:
+        fn()
+    finally:
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        done.set()
+        if baseline is not None:
+            sampler.join()
+    return {
+        "tracemalloc_peak_kib": traced_peak // 1024,
+        "rss_peak_delta_kib": None if baseline is None else peak[0] - baseline,
+    }
+
+
+def time_target(fn, repeats):
+    start = time.perf_counter()
+    fn()
+    first = time.perf_counter() - start
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {
+        "first_s": first,
+        "min_s": min(runs),
+        "median_s": statistics.median(runs),
+        "mean_s": statistics.fmean(runs),
+        "repeats": repeats,
+    }
+
+
+def benchmark_targets(msgs, outdir):
+    # match the fonts and widths the renderers use internally
+    convo_font = conversation_font()
+    convo_width = CONVO_MAX_BUBBLE_WIDTH - 2 * CONVO_PAD
+    chain_font = ImageFont.truetype("Arial.ttf", CHAIN_TEXT_SIZE)
+    chain_width = (
+        CHAIN_WIDTH
+        - CHAIN_SIDE_MARGIN
+        - (CHAIN_BADGE_SIZE + CHAIN_TEXT_BADGE_GAP + CHAIN_SIDE_MARGIN)
+    )
+
+    color_left = {"bubble_hex": "#3a3a3c", "text_hex": "#ffffff"}
+    color_right = {"bubble_hex": "#0a84ff", "text_hex": "#ffffff"}
+
+    return {
+        "wrap_text": lambda: [
+            wrap_text(m.content, convo_font, convo_width) for m in msgs
+        ],
+        "wrap_text_by_width": lambda: [
+            wrap_text_by_width(m.content, chain_font, chain_width) for m in msgs
+        ],
+        "render_conversation": lambda: render_conversation(
+            msgs,
+            color_left,
+            color_right,
+            "#000000",
+            os.path.join(outdir, "conversation.png"),
+        ),
+        "render_reddit_chain": lambda: render_reddit_chain(
+            msgs, os.path.join(outdir, "chain.png")
+        ),
+    }
+
+
+def run(scenarios, targets, repeats, seed, live_emoji):
+    server, base_url = start_stub_server()
+    if not live_emoji:
+        AppleEmojiSource.BASE_EMOJI_CDN_URL = f"{base_url}/emoji/"
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as outdir:
+            for scenario in scenarios:
+                msgs = generate_conversation(scenario, seed, base_url)
+                for target, fn in benchmark_targets(msgs, outdir).items():
+                    if targets and target not in targets:
+                        continue
+                    timing = time_target(fn, repeats)
+                    memory = peak_memory(fn)
+                    results.append(
+                        {
+                            "scenario": scenario.name,
+                            "target": target,
+                            "messages": len(msgs),
+                            "chars": sum(len(m.content) for m in msgs),
+                            **timing,
+                            **memory,
+                        }
+                    )
+                    print(
+                        f"{scenario.name:12} {target:20} "
+                        f"median {timing['median_s'] * 1000:8.1f} ms  "
+                        f"first {timing['first_s'] * 1000:8.1f} ms  "
+                        f"rss +{memory['rss_peak_delta_kib']} KiB"
+                    )
+    finally:
+        server.shutdown()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the conversation and reddit-chain renderers"
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=[s.name for s in SCENARIOS],
+        help="Scenario to run (repeatable, default: all)",
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        choices=[
+            "wrap_text",
+            "wrap_text_by_width",
+            "render_conversation",
+            "render_reddit_chain",
+        ],
+        help="Function to time (repeatable, default: all)",
+    )
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--live-emoji",
+        action="store_true",
+        help="Fetch emoji from the real CDN instead of the local stub",
+    )
+    parser.add_argument("--output_file", default="benchmark_results.json")
+
+    args = parser.parse_args()
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    results = run(scenarios, args.target, args.repeats, args.seed, args.live_emoji)
+
+    with open(args.output_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "python": sys.version.split()[0],
+                "pillow": PIL.__version__,
+                "platform": platform.platform(),
+                "seed": args.seed,
+                "scenarios": [asdict(s) for s in scenarios],
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {args.output_file}")
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# keep test runs from reading or polluting the bot's own caches
+os.environ.setdefault("TT_CACHE_DIR", tempfile.mkdtemp(prefix="tt-test-cache-"))
@@ -0,0 +1,224 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import praw
+import pytest
+
+import utils
+from texting_theory import Classification, TextMessage
+
+
+class FakeReddit(BaseHTTPRequestHandler):
+    # Just enough of oauth.reddit.com and the media upload bucket for
+    # ApiBackend: token, info, media lease, upload and comment.
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/api/info":
+            return self._send_json({}, 404)
+        fullnames = parse_qs(url.query)["id"][0].split(",")
+        children = [
+            {"kind": "t3", "data": {"id": name[3:], "title": f"Title of {name[3:]}"}}
+            for name in fullnames
+        ]
+        self._send_json(
+            {"kind": "Listing", "data": {"children": children, "after": None}}
+        )
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        path = urlparse(self.path).path
+        server = self.server
+        if path == "/api/v1/access_token":
+            self._send_json(
+                {
+                    "access_token": "token",
+                    "expires_in": 3600,
+                    "scope": "*",
+                    "token_type": "bearer",
+                }
+            )
+        elif path == "/api/media/asset.json":
+            server.leases.append(parse_qs(body.decode()))
+            if server.fail_upload:
+                return self._send_json({}, 400)
+            self._send_json(
+                {
+                    "args": {
+                        "action": f"{server.url}/upload",
+                        "fields": [{"name": "key", "value": "media/image.png"}],
+                    },
+                    "asset": {"asset_id": "asset123", "websocket_url": ""},
+                }
+            )
+        elif path == "/upload":
+            server.uploads.append(body)
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        elif path == "/api/comment":
+            form = parse_qs(body.decode())
+            server.comments.append(
+                (form["thing_id"][0], json.loads(form["richtext_json"][0]))
+            )
+            self._send_json({"json": {"errors": [], "data": {"things": []}}})
+        else:
+            self._send_json({}, 404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RecordingBackend(utils.CommentBackend):
+    def __init__(self):
+        self.calls = []
+
+    def post_analysis(self, post_id, file_path, messages, *details):
+        self.calls.append(("analysis", post_id))
+
+    def post_image_reply(self, post_id, comment_id, file_path):
+        self.calls.append(("reply", comment_id))
+
+
+@pytest.fixture
+def fake_reddit(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeReddit)
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    server.leases, server.uploads, server.comments = [], [], []
+    server.fail_upload = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    reddit = praw.Reddit(
+        client_id="client",
+        client_secret="secret",
+        username="texting-theory-bot",
+        password="password",
+        user_agent="texting-theory-bot tests",
+        oauth_url=server.url,
+        reddit_url=server.url,
+    )
+    monkeypatch.setattr(utils, "reddit_client", lambda: reddit)
+    utils._post_info.clear()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def image(tmp_path):
+    path = tmp_path / "analysis.png"
+    path.write_bytes(b"\x89PNG fake image bytes")
+    return str(path)
+
+
+MESSAGES = [
+    TextMessage(side="left", content="hey", classification=Classification.BEST),
+    TextMessage(side="right", content="hi", classification=Classification.BLUNDER),
+    TextMessage(side="right", content="?", classification=Classification.FORCED),
+]
+
+DETAILS = (
+    "White",  # color_left
+    "Black",  # color_right
+    800,  # elo_left
+    650,  # elo_right
+    "Hinge Opening",
+    [("sim1", 0.93, "hey\n\nhi")],  # similar_conversations
+    "2.5",  # evaluation
+    None,  # best_continuation
+    "Left kept it simple.",  # summary
+)
+
+
+def spans(document):
+    for block in document:
+        yield from block.get("c", []) if block["e"] == "par" else []
+
+
+def test_post_analysis_uploads_image_and_submits_richtext(fake_reddit, image):
+    with utils.ApiBackend() as backend:
+        backend.post_analysis("abc", image, MESSAGES, *DETAILS)
+
+    [lease] = fake_reddit.leases
+    assert lease["filepath"] == ["analysis.png"]
+    assert lease["mimetype"] == ["image/png"]
+    assert len(fake_reddit.uploads) == 1
+    assert b"fake image bytes" in fake_reddit.uploads[0]
+
+    [(thing_id, richtext)] = fake_reddit.comments
+    assert thing_id == "t3_abc"
+    document = richtext["document"]
+    assert document[0] == {
+        "e": "par",
+        "c": [{"e": "text", "t": "✪ Game Review", "f": [[utils.RTJSON_BOLD, 0, 13]]}],
+    }
+    assert {"e": "img", "id": "asset123"} in document
+    texts = [span["t"] for span in spans(document)]
+    assert "Left kept it simple." in texts
+    assert utils.format_eval_bar(MESSAGES, "2.5") in texts
+
+    [table] = [block for block in document if block["e"] == "table"]
+    assert table["h"][0]["c"][0]["t"] == "White (800)"
+    assert table["h"][2]["c"][0]["t"] == "Black (650)"
+    rows = {
+        row[1]["c"][0]["t"]: (row[0]["c"][0]["t"], row[2]["c"][0]["t"])
+        for row in table["c"]
+    }
+    assert "Megablunder" not in rows
+    assert rows["Best"] == ("1", "0")
+    assert rows["Blunder"] == ("0", "1")
+    assert rows["Good"] == ("0", "1")  # forced moves count as good
+
+    links = [span for span in spans(document) if span["e"] == "link"]
+    assert links[0]["t"] == "Title of sim1"
+    assert links[0]["u"].endswith("/comments/sim1/")
+    assert [link["t"] for link in links[1:]] == [text for text, _ in utils.ABOUT_LINKS]
+    assert all(
+        link["f"] == [[utils.RTJSON_SUPERSCRIPT, 0, len(link["t"])]]
+        for link in links[1:]
+    )
+
+
+def test_post_image_reply_comments_with_only_the_image(fake_reddit, image):
+    utils.ApiBackend().post_image_reply("abc", "c1", image)
+
+    assert fake_reddit.comments == [
+        ("t1_c1", {"document": [{"e": "img", "id": "asset123"}]})
+    ]
+
+
+def test_failed_upload_goes_through_fallback(fake_reddit, image):
+    fake_reddit.fail_upload = True
+    fallback = RecordingBackend()
+    backend = utils.ApiBackend(fallback=fallback)
+
+    backend.post_analysis("abc", image, MESSAGES, *DETAILS)
+    backend.post_image_reply("abc", "c1", image)
+
+    assert fallback.calls == [("analysis", "abc"), ("reply", "c1")]
+    assert fake_reddit.comments == []
+
+
+def test_failed_upload_without_fallback_raises(fake_reddit, image):
+    fake_reddit.fail_upload = True
+
+    with pytest.raises(Exception):
+        utils.ApiBackend().post_image_reply("abc", "c1", image)
+    assert fake_reddit.comments == []
+
+
+def test_backends_must_implement_posting():
+    class Incomplete(utils.CommentBackend):
+        def post_analysis(self, post_id, file_path, messages, *details):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+import pytest
+
+import utils
+
+
+def comment(post_id, parent_id=None, created_utc=100):
+    link_id = f"t3_{post_id}"
+    return SimpleNamespace(
+        link_id=link_id, parent_id=parent_id or link_id, created_utc=created_utc
+    )
+
+
+@pytest.fixture
+def bot_listing(monkeypatch):
+    comments = []
+    redditor = SimpleNamespace(
+        comments=SimpleNamespace(new=lambda limit: comments[:limit])
+    )
+    reddit = SimpleNamespace(redditor=lambda name: redditor)
+    monkeypatch.setattr(utils, "reddit_client", lambda: reddit)
+    monkeypatch.setattr(utils, "bot_username", lambda: "texting-theory-bot")
+    return comments
+
+
+def test_top_level_comment_marks_post_analyzed(bot_listing):
+    bot_listing.append(comment("abc"))
+    index = utils.BotCommentIndex()
+
+    assert index.lookup(SimpleNamespace(id="abc", created_utc=200)) is True
+    assert index.lookup(SimpleNamespace(id="def", created_utc=200)) is False
+
+
+def test_nested_reply_does_not_mark_post_analyzed(bot_listing):
+    # an !annotate reply on a post the bot never reviewed
+    bot_listing.append(comment("abc", parent_id="t1_usercomment"))
+    index = utils.BotCommentIndex()
+
+    assert index.lookup(SimpleNamespace(id="abc", created_utc=200)) is False
+
+
+def test_posts_older_than_a_full_listing_are_unknown(bot_listing):
+    bot_listing.extend(comment(f"p{i}", created_utc=100 + i) for i in range(3))
+    index = utils.BotCommentIndex(limit=3)
+
+    assert index.lookup(SimpleNamespace(id="old", created_utc=50)) is None
+    assert index.lookup(SimpleNamespace(id="new", created_utc=150)) is False
@@ -0,0 +1,160 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import unquote
+
+import pytest
+
+import utils
+
+
+class FakeKV(BaseHTTPRequestHandler):
+    # Cloudflare's KV REST API for one namespace: single-key reads and bulk
+    # writes. Keys in server.broken answer 403.
+    def _send(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        key = unquote(self.path.rsplit("/values/", 1)[1])
+        server.requests.append(("GET", key))
+        if key in server.broken:
+            return self._send(403, b'{"success":false}')
+        if key not in server.store:
+            return self._send(404, b'{"success":false}')
+        self._send(200, server.store[key].encode())
+
+    def do_PUT(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server.requests.append(("PUT", self.path.rsplit("/", 1)[1]))
+        server.auth.append(self.headers["Authorization"])
+        if server.reject_writes:
+            return self._send(403, b'{"success":false}')
+        for item in body:
+            server.store[item["key"]] = item["value"]
+        self._send(200, b'{"success":true}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def kv():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeKV)
+    server.store, server.requests, server.auth = {}, [], []
+    server.broken = set()
+    server.reject_writes = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = utils.KVClient(
+        account_id="account",
+        namespace_id="namespace",
+        api_token="token",
+        base_url=f"http://127.0.0.1:{server.server_port}",
+    )
+    yield server, client
+    server.shutdown()
+
+
+def test_reads_are_cached_including_misses(kv):
+    server, client = kv
+    server.store["post:a"] = json.dumps({"opening": "x"})
+
+    assert client.get_json("post:a") == {"opening": "x"}
+    assert client.get_json("post:a") == {"opening": "x"}
+    assert client.get_json("post:missing") is None
+    assert client.get_json("post:missing") is None
+    assert server.requests == [("GET", "post:a"), ("GET", "post:missing")]
+
+
+def test_get_many_dedupes_and_skips_failed_keys(kv):
+    server, client = kv
+    server.store["post:a"] = json.dumps(1)
+    server.store["post:b"] = json.dumps(2)
+    server.broken.add("post:b")
+
+    values = client.get_many(["post:a", "post:b", "post:a", "post:c"])
+
+    assert values == {"post:a": 1, "post:c": None}
+    assert sorted(server.requests) == [
+        ("GET", "post:a"),
+        ("GET", "post:b"),
+        ("GET", "post:c"),
+    ]
+    # the failed key isn't cached, so it's read again and still raises
+    with pytest.raises(Exception):
+        client.get_json("post:b")
+
+
+def test_queued_writes_are_readable_and_flushed_in_one_bulk_put(kv):
+    server, client = kv
+    client.put_json("post:a", {"n": 1})
+    client.put_json("post:b", {"n": 2})
+
+    assert client.get_json("post:a") == {"n": 1}
+    assert server.requests == []
+
+    client.flush()
+
+    assert server.requests == [("PUT", "bulk")]
+    assert server.auth == ["Bearer token"]
+    assert json.loads(server.store["post:a"]) == {"n": 1}
+    assert json.loads(server.store["post:b"]) == {"n": 2}
+    client.flush()  # nothing pending, nothing sent
+    assert server.requests == [("PUT", "bulk")]
+
+
+def test_failed_flush_keeps_writes_queued(kv):
+    server, client = kv
+    server.reject_writes = True
+    client.put_json("post:a", {"n": 1})
+
+    with pytest.raises(Exception):
+        client.flush()
+    assert server.store == {}
+
+    server.reject_writes = False
+    client.flush()
+    assert json.loads(server.store["post:a"]) == {"n": 1}
+
+
+def test_posts_finished_together_are_flushed_in_one_bulk_put(kv, monkeypatch):
+    server, client = kv
+    posts = [SimpleNamespace(id=f"sweep{i}", title="t") for i in range(3)]
+
+    data = {"elo": {}, "color": {}, "opening": "Hinge Opening", "coach_insight": ""}
+
+    def analyze(post, workdir):
+        return "analyzed", utils.PostAnalysis(
+            post=post, data=data, msgs=[], out_path="", convo_text=""
+        )
+
+    class Backend(utils.CommentBackend):
+        def post_analysis(self, post_id, file_path, messages, *details):
+            pass
+
+        def post_image_reply(self, post_id, comment_id, file_path):
+            pass
+
+    monkeypatch.setattr(utils, "kv_client", lambda: client)
+    monkeypatch.setattr(utils, "get_recent_posts", lambda: posts)
+    monkeypatch.setattr(utils, "post_content_hash", lambda post: post.id)
+    monkeypatch.setattr(utils, "already_processed", lambda post, h: False)
+    monkeypatch.setattr(utils, "already_analyzed", lambda post, refresh=False: False)
+    monkeypatch.setattr(utils, "analyze_post", analyze)
+    monkeypatch.setattr(utils, "drop_deleted_conversations", lambda analyses: None)
+    monkeypatch.setattr(utils, "vector_insert", lambda *args: None)
+    monkeypatch.setattr(utils, "record_outcome", lambda *args: None)
+    monkeypatch.setattr(utils, "comment_backend", Backend)
+    # hand every analysis to the posting loop as one batch; result() blocks
+    # until each one is done
+    monkeypatch.setattr(utils, "wait", lambda fs, return_when: (set(fs), set()))
+
+    utils.handle_new_posts()
+
+    assert server.requests == [("PUT", "bulk")]
+    assert sorted(server.store) == ["post:sweep0", "post:sweep1", "post:sweep2"]
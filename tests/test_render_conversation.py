@@ -0,0 +1,129 @@
+import io
+
+import pytest
+from PIL import Image, ImageChops, ImageColor, ImageDraw
+from pilmoji import Pilmoji
+from pilmoji.source import BaseSource
+
+import texting_theory
+from texting_theory import Classification, TextMessage
+
+COLOR_LEFT = {"bubble_hex": "#262629", "text_hex": "#ffffff"}
+COLOR_RIGHT = {"bubble_hex": "#0a84ff", "text_hex": "#ffffff"}
+BACKGROUND = "#000000"
+
+
+class TallEmoji(BaseSource):
+    # An opaque emoji three times taller than it is wide, so it hangs out of
+    # its bubble and over the next bubble's badge.
+    def get_emoji(self, emoji, /):
+        out = io.BytesIO()
+        Image.new("RGBA", (160, 480), (220, 40, 40, 255)).save(out, "PNG")
+        out.seek(0)
+        return out
+
+    def get_discord_emoji(self, id, /):
+        return None
+
+
+@pytest.fixture(autouse=True)
+def emoji(monkeypatch, tmp_path):
+    monkeypatch.setattr(texting_theory, "EMOJI_CACHE_DIR", str(tmp_path))
+    source = texting_theory.CachedEmojiSource(
+        round(
+            texting_theory.CONVO_EMOJI_SCALE * texting_theory.conversation_font().size
+        ),
+        upstream=TallEmoji(),
+    )
+    monkeypatch.setattr(texting_theory, "conversation_emoji_source", lambda: source)
+    return source
+
+
+def render_in_original_order(layout, messages):
+    # background, badges, bubbles, then text, all in one pass
+    img = Image.new(
+        "RGBA", (layout.width, layout.height), ImageColor.getcolor(BACKGROUND, "RGBA")
+    )
+    bubble_layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
+    bubble_draw = ImageDraw.Draw(bubble_layer)
+    for b, m in zip(layout.bubbles, messages):
+        badge = texting_theory.get_badge(
+            m.classification,
+            "white" if b.side == "right" else "black",
+            texting_theory.CONVO_BADGE_SIZE,
+            Image.BICUBIC,
+        )
+        img.paste(badge, b.badge_pos, badge)
+        color = (COLOR_LEFT if b.side == "left" else COLOR_RIGHT)["bubble_hex"]
+        if b.unsent:
+            for bbox in b.tail:
+                bubble_draw.ellipse(bbox, fill=color)
+        else:
+            bubble_draw.polygon(b.tail, fill=color)
+        bubble_draw.rounded_rectangle(b.rect, texting_theory.CONVO_RADIUS, fill=color)
+    img = Image.alpha_composite(img, bubble_layer)
+    with Pilmoji(img, source=texting_theory.conversation_emoji_source()) as pilmoji:
+        for b in layout.bubbles:
+            pilmoji.text(
+                b.text_pos,
+                b.text.text,
+                font=texting_theory.conversation_font(),
+                fill=(COLOR_LEFT if b.side == "left" else COLOR_RIGHT)["text_hex"],
+                spacing=texting_theory.CONVO_LINE_SPACING,
+                emoji_scale_factor=texting_theory.CONVO_EMOJI_SCALE,
+                emoji_position_offset=(b.emoji_offset, 0),
+            )
+    return img.convert("RGB")
+
+
+@pytest.mark.parametrize(
+    "messages, spills",
+    [
+        (
+            [
+                TextMessage(
+                    side="left", content="hey", classification=Classification.BEST
+                ),
+                TextMessage(
+                    side="right", content="hi there", classification=Classification.GOOD
+                ),
+                TextMessage(
+                    side="right",
+                    content="?",
+                    classification=Classification.BLUNDER,
+                    unsent=True,
+                ),
+            ],
+            False,
+        ),
+        (
+            [
+                TextMessage(
+                    side="left", content="hey 😀", classification=Classification.BEST
+                ),
+                TextMessage(
+                    side="left", content="a", classification=Classification.BRILLIANT
+                ),
+                TextMessage(
+                    side="right", content="ok 😀", classification=Classification.MISTAKE
+                ),
+            ],
+            True,
+        ),
+    ],
+)
+def test_render_matches_drawing_badges_under_the_bubbles(tmp_path, messages, spills):
+    layout = texting_theory.layout_conversation(messages)
+    out_path = tmp_path / "out.png"
+
+    texting_theory.render_conversation(
+        messages, COLOR_LEFT, COLOR_RIGHT, BACKGROUND, str(out_path)
+    )
+
+    _, text_drawings = texting_theory.draw_conversation_base(
+        layout, COLOR_LEFT, COLOR_RIGHT, BACKGROUND
+    )
+    assert (text_drawings is not None) == spills
+    with Image.open(out_path) as rendered:
+        expected = render_in_original_order(layout, messages)
+        assert ImageChops.difference(rendered, expected).getbbox() is None
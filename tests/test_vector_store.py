@@ -0,0 +1,107 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from vector_store import LocalVectorStore
+
+
+class SmallIVFStore(LocalVectorStore):
+    IVF_MIN_VECTORS = 64
+    IVF_PROBES = 2
+
+
+def random_vectors(count, dim=16, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def test_empty_store_returns_nothing(tmp_path):
+    assert LocalVectorStore(str(tmp_path)).query([1.0, 0.0], top_k=3) == []
+
+
+def test_query_ranks_by_cosine_similarity(tmp_path):
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert("a", [1.0, 0.0, 0.0], "hey")
+    store.upsert("b", [1.0, 1.0, 0.0], "hi")
+    store.upsert("c", [0.0, 0.0, 5.0], "yo")
+
+    matches = store.query([2.0, 0.0, 0.0], top_k=2)
+
+    assert [(m.id, m.convo_text) for m in matches] == [("a", "hey"), ("b", "hi")]
+    assert matches[0].score == pytest.approx(1.0)
+    assert matches[1].score == pytest.approx(np.sqrt(0.5))
+    with pytest.raises(ValueError):
+        store.upsert("d", [1.0, 0.0], "wrong size")
+
+
+def test_upsert_supersedes_earlier_row(tmp_path):
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert("a", [1.0, 0.0], "old")
+    store.upsert("b", [0.6, 0.8], "other")
+    store.upsert("a", [0.0, 1.0], "new")
+
+    for opened in (store, LocalVectorStore(str(tmp_path))):
+        assert len(opened) == 2
+        matches = opened.query([1.0, 0.0], top_k=3)
+        assert [(m.id, m.convo_text) for m in matches] == [
+            ("b", "other"),
+            ("a", "new"),
+        ]
+
+
+def test_reopen_trims_an_interrupted_upsert(tmp_path):
+    store = LocalVectorStore(str(tmp_path))
+    vectors = random_vectors(3, dim=4)
+    for i, vector in enumerate(vectors):
+        store.upsert(f"p{i}", vector, f"text {i}")
+
+    # the vector of a fourth row made it halfway, its item line not at all,
+    # and the items file also ends in a torn line
+    with open(tmp_path / "vectors.f32", "ab") as f:
+        f.write(b"\0" * 8)
+    with open(tmp_path / "items.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"id": "p3", "convo')
+
+    reopened = LocalVectorStore(str(tmp_path))
+
+    assert len(reopened) == 3
+    assert os.path.getsize(tmp_path / "vectors.f32") == 3 * 4 * 4
+    with open(tmp_path / "items.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["id"] for line in f] == ["p0", "p1", "p2"]
+
+    # rows appended after the trim line up with their items again
+    reopened.upsert("p3", [0.0, 0.0, 0.0, 1.0], "text 3")
+    [match] = LocalVectorStore(str(tmp_path)).query([0.0, 0.0, 0.0, 1.0], top_k=1)
+    assert (match.id, match.convo_text) == ("p3", "text 3")
+    assert match.score == pytest.approx(1.0)
+
+
+def test_items_ahead_of_vectors_are_dropped_on_reopen(tmp_path):
+    store = LocalVectorStore(str(tmp_path))
+    store.upsert("p0", [1.0, 0.0], "text 0")
+    with open(tmp_path / "items.jsonl", "a", encoding="utf-8") as f:
+        f.write(json.dumps({"id": "p1", "convo_text": "text 1"}) + "\n")
+
+    reopened = LocalVectorStore(str(tmp_path))
+
+    assert len(reopened) == 1
+    assert [m.id for m in reopened.query([0.0, 1.0], top_k=5)] == ["p0"]
+
+
+def test_queries_after_ivf_rebuild_find_every_row(tmp_path):
+    store = SmallIVFStore(str(tmp_path))
+    vectors = random_vectors(160)
+    for i, vector in enumerate(vectors):
+        store.upsert(f"p{i}", vector, f"text {i}")
+
+    # built at 64 rows, rebuilt at 128; the last 32 rows aren't indexed yet
+    assert store._ivf_rows == 128
+    assert len(store._lists) == 128
+
+    for opened in (store, SmallIVFStore(str(tmp_path))):
+        assert opened._ivf_rows == 128
+        for i in (0, 63, 64, 127, 128, 159):
+            [match] = opened.query(vectors[i], top_k=1)
+            assert (match.id, match.convo_text) == (f"p{i}", f"text {i}")
+            assert match.score == pytest.approx(1.0)
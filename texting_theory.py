@@ -1,23 +1,31 @@
+import asyncio
 import enum
+import functools
+import hashlib
 import json
+import math
 import os
 import random
 import textwrap
+import threading
 import requests
 import io
-from dataclasses import dataclass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import asdict, dataclass
 from zoneinfo import ZoneInfo
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import List
 from pilmoji import Pilmoji
-from pilmoji.source import AppleEmojiSource
+from pilmoji.helpers import NodeType, to_nodes
+from pilmoji.source import AppleEmojiSource, BaseSource
 from PIL import Image, ImageDraw, ImageFont, ImageColor
 from google import genai
 from google.genai import types
 from prompt import decrypt_prompt
 from random_key import key_id
 
-
 # from dotenv import load_dotenv
 # load_dotenv()
 
@@ -51,6 +59,30 @@ class Classification(enum.Enum):
                 return f"badges/{self.value}.png"
 
 
+BADGE_COLORS = ("white", "black")
+
+
+@functools.cache
+def badge_atlas(size: int, resample=Image.LANCZOS) -> dict:
+    # Every badge decoded and resized once per (size, resample) for the process
+    resized = {}
+    atlas = {}
+    for classification in Classification:
+        for color in BADGE_COLORS:
+            path = classification.png_path(color)
+            if path not in resized:
+                if not os.path.exists(path):
+                    continue
+                with Image.open(path) as badge:
+                    resized[path] = badge.convert("RGBA").resize((size, size), resample)
+            atlas[(classification, color)] = resized[path]
+    return atlas
+
+
+def get_badge(classification, color: str, size: int, resample=Image.LANCZOS):
+    return badge_atlas(size, resample).get((classification, color))
+
+
 def api_key():
     return os.environ["GEMINI_API_KEY"]
 
@@ -75,75 +107,250 @@ def load_system_prompt():
     return system_prompt
 
 
-API_KEY = api_key()
-client = genai.Client(api_key=API_KEY)
-SYSTEM_PROMPT = load_system_prompt()
+def singleton(factory):
+    # Process-wide instance built on first call; the lock keeps concurrent
+    # first callers (e.g. the analysis pool) from building it twice.
+    lock = threading.Lock()
+    instance = []
 
+    @functools.wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
 
-def call_llm_on_image(image_paths: list[str], title: str, body: str) -> dict:
+    return get
+
+
+@singleton
+def gemini_client():
+    return genai.Client(api_key=api_key())
+
+
+@singleton
+def system_prompt():
+    return load_system_prompt()
+
+
+CACHE_DIR = os.environ.get("TT_CACHE_DIR", ".cache")
+UPLOAD_CACHE_FILE = os.path.join(CACHE_DIR, "gemini_uploads.json")
+# reuse an upload while it has at least this long left, refresh it in the
+# background once it gets closer to expiring than UPLOAD_REFRESH_AHEAD
+UPLOAD_MIN_TTL = timedelta(hours=1)
+UPLOAD_REFRESH_AHEAD = timedelta(hours=12)
+
+_upload_cache_lock = threading.Lock()
+_upload_cache = None
+_upload_refreshing = set()
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+_prune_lock = threading.Lock()
+
+
+def prune_cache_dir(path: str, limit: int):
+    # Keeps the `limit` most recently used files in `path`, going by mtime;
+    # readers touch the files they hit so the mtime tracks last use.
+    with _prune_lock:
+        try:
+            entries = [e for e in os.scandir(path) if e.is_file()]
+        except FileNotFoundError:
+            return
+        if len(entries) <= limit:
+            return
+        files = []
+        for entry in entries:
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+        files.sort(reverse=True)
+        for _, file_path in files[limit:]:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+
+
+def touch_cache_file(path: str):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _prune_expired_uploads(cache: dict):
+    now = datetime.now(timezone.utc)
+    for digest, entry in list(cache.items()):
+        if datetime.fromisoformat(entry["expires"]) <= now:
+            del cache[digest]
+
+
+def _load_upload_cache() -> dict:
+    global _upload_cache
+    if _upload_cache is None:
+        try:
+            with open(UPLOAD_CACHE_FILE, "r", encoding="utf-8") as f:
+                _upload_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            _upload_cache = {}
+        _prune_expired_uploads(_upload_cache)
+    return _upload_cache
+
+
+def _save_upload_cache():
+    _prune_expired_uploads(_upload_cache)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = UPLOAD_CACHE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(_upload_cache, f)
+    os.replace(tmp_path, UPLOAD_CACHE_FILE)
+
+
+def _remember_upload(digest: str, uploaded) -> dict:
+    expires = uploaded.expiration_time or (
+        datetime.now(timezone.utc) + timedelta(hours=48)
+    )
+    entry = {
+        "uri": uploaded.uri,
+        "name": uploaded.name,
+        "mime_type": uploaded.mime_type,
+        "expires": expires.isoformat(),
+    }
+    with _upload_cache_lock:
+        _load_upload_cache()[digest] = entry
+        _save_upload_cache()
+    return entry
+
+
+def _refresh_upload(digest: str, path: str):
+    try:
+        _remember_upload(digest, gemini_client().files.upload(file=path))
+        print(f"Refreshed Gemini upload for {path}")
+    except Exception as e:
+        print(f"[!] Background refresh of {path} failed: {e}")
+    finally:
+        with _upload_cache_lock:
+            _upload_refreshing.discard(digest)
+
+
+def _cached_upload_uri(digest: str, path: str) -> str | None:
+    now = datetime.now(timezone.utc)
+    with _upload_cache_lock:
+        entry = _load_upload_cache().get(digest)
+    if entry is None:
+        return None
+    remaining = datetime.fromisoformat(entry["expires"]) - now
+    if remaining <= UPLOAD_MIN_TTL:
+        return None
+    if remaining < UPLOAD_REFRESH_AHEAD:
+        with _upload_cache_lock:
+            start = digest not in _upload_refreshing
+            _upload_refreshing.add(digest)
+        if start:
+            threading.Thread(target=_refresh_upload, args=(digest, path)).start()
+    return entry["uri"]
+
+
+def upload_file_cached(path: str) -> str:
+    digest = file_sha256(path)
+    uri = _cached_upload_uri(digest, path)
+    if uri is not None:
+        return uri
+    return _remember_upload(digest, gemini_client().files.upload(file=path))["uri"]
+
+
+async def upload_file_cached_async(path: str) -> str:
+    digest = await asyncio.to_thread(file_sha256, path)
+    uri = _cached_upload_uri(digest, path)
+    if uri is not None:
+        return uri
+    uploaded = await gemini_client().aio.files.upload(file=path)
+    return (await asyncio.to_thread(_remember_upload, digest, uploaded))["uri"]
+
+
+LLM_MODEL = "gemini-2.5-flash-preview-05-20"
+
+
+def llm_system_instruction() -> str:
     if datetime.now(ZoneInfo("America/New_York")).weekday() == 0:
         extra = "\n\nAddendum: Today is Monday, which means you have the ability to classify a message as a `MEGABLUNDER`. Use it sparingly, only for the worst-of-the-worst."
     else:
         extra = ""
+    return system_prompt() + extra
 
-    main_images = [client.files.upload(file=img_path) for img_path in image_paths]
-    example_r = client.files.upload(file="examples/r.png")
-    example_l = client.files.upload(file="examples/l.png")
 
+def build_llm_contents(
+    main_image_uris: list[str],
+    example_r_uri: str,
+    example_l_uri: str,
+    title: str,
+    body: str,
+) -> list[types.Part]:
     contents = [
         types.Part.from_text(text=f'Post Title: "{title}"\n\nPost Body: "{body}"')
     ]
-    for main_image in main_images:
+    for main_image_uri in main_image_uris:
         contents.append(
-            types.Part.from_uri(file_uri=main_image.uri, mime_type="image/jpeg")
+            types.Part.from_uri(file_uri=main_image_uri, mime_type="image/jpeg")
         )
     contents.extend(
         [
             types.Part.from_text(
                 text="Here is a blank example of a Hinge prompt from left being replied to by right (pink bubble with tail pointing to right):"
             ),
-            types.Part.from_uri(file_uri=example_r.uri, mime_type="image/png"),
+            types.Part.from_uri(file_uri=example_r_uri, mime_type="image/png"),
             types.Part.from_text(
                 text="Here is a blank example of a Hinge prompt from right being replied to by left (pink bubble with tail pointing to left):"
             ),
-            types.Part.from_uri(file_uri=example_l.uri, mime_type="image/png"),
+            types.Part.from_uri(file_uri=example_l_uri, mime_type="image/png"),
         ]
     )
-
-    response = client.models.generate_content(
-        # model="gemini-2.5-pro-exp-03-25",
-        model="gemini-2.5-flash-preview-05-20",
-        contents=contents,
-        config=types.GenerateContentConfig(
-            system_instruction=SYSTEM_PROMPT + extra,
-            # temperature=0.3,
-            # top_k=1.0,
-            # seed=63,
-            thinking_config=types.ThinkingConfig(thinking_budget=24576),
-            safety_settings=[
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-                types.SafetySetting(
-                    category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
-                    threshold=types.HarmBlockThreshold.OFF,
-                ),
-            ],
-        ),
+    return contents
+
+
+def llm_generate_config() -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=llm_system_instruction(),
+        # temperature=0.3,
+        # top_k=1.0,
+        # seed=63,
+        thinking_config=types.ThinkingConfig(thinking_budget=24576),
+        safety_settings=[
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HARASSMENT,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+            types.SafetySetting(
+                category=types.HarmCategory.HARM_CATEGORY_CIVIC_INTEGRITY,
+                threshold=types.HarmBlockThreshold.OFF,
+            ),
+        ],
     )
+
+
+def parse_llm_output(response) -> dict:
     #   print(response.__dict__)
     print(f"Result: {response.text}")
     text = response.text[response.text.find("```json") :]
@@ -151,6 +358,41 @@ def call_llm_on_image(image_paths: list[str], title: str, body: str) -> dict:
     return data
 
 
+def call_llm_on_image(image_paths: list[str], title: str, body: str) -> dict:
+    main_image_uris = [upload_file_cached(img_path) for img_path in image_paths]
+    example_r_uri = upload_file_cached("examples/r.png")
+    example_l_uri = upload_file_cached("examples/l.png")
+
+    response = gemini_client().models.generate_content(
+        # model="gemini-2.5-pro-exp-03-25",
+        model=LLM_MODEL,
+        contents=build_llm_contents(
+            main_image_uris, example_r_uri, example_l_uri, title, body
+        ),
+        config=llm_generate_config(),
+    )
+    return parse_llm_output(response)
+
+
+async def call_llm_on_image_async(
+    image_paths: list[str], title: str, body: str
+) -> dict:
+    *main_image_uris, example_r_uri, example_l_uri = await asyncio.gather(
+        *(upload_file_cached_async(img_path) for img_path in image_paths),
+        upload_file_cached_async("examples/r.png"),
+        upload_file_cached_async("examples/l.png"),
+    )
+
+    response = await gemini_client().aio.models.generate_content(
+        model=LLM_MODEL,
+        contents=build_llm_contents(
+            main_image_uris, example_r_uri, example_l_uri, title, body
+        ),
+        config=llm_generate_config(),
+    )
+    return parse_llm_output(response)
+
+
 def parse_llm_response(data, ignore_classifications=False) -> List[TextMessage]:
     msgs = []
     no_book = False
@@ -191,223 +433,702 @@ def parse_llm_response(data, ignore_classifications=False) -> List[TextMessage]:
     return msgs
 
 
-def wrap_text(text, draw, font, max_width):
+class TextMeasurer:
+    # Widths of words and pairs are cached per font so a line can be measured
+    # incrementally instead of re-measuring the whole line for every word.
+    MAX_ENTRIES = 50000
+
+    def __init__(self, font):
+        self.font = font
+        self._lengths = {}
+        self._bboxes = {}
+        self._kerning = {}
+
+    def _trim(self, cache):
+        if len(cache) > self.MAX_ENTRIES:
+            cache.clear()
+
+    def length(self, text: str) -> float:
+        try:
+            return self._lengths[text]
+        except KeyError:
+            self._trim(self._lengths)
+            value = self._lengths[text] = self.font.getlength(text)
+            return value
+
+    def bbox(self, text: str) -> tuple[int, int, int, int]:
+        try:
+            return self._bboxes[text]
+        except KeyError:
+            self._trim(self._bboxes)
+            value = self._bboxes[text] = self.font.getbbox(text)
+            return value
+
+    def kern(self, left: str, right: str) -> float:
+        pair = left + right
+        try:
+            return self._kerning[pair]
+        except KeyError:
+            self._trim(self._kerning)
+            value = self._kerning[pair] = (
+                self.length(pair) - self.length(left) - self.length(right)
+            )
+            return value
+
+    # `prefix` only needs to end with the last character of the joined prefix
+    def joined_length(self, prefix_length: float, prefix: str, text: str) -> float:
+        if not prefix:
+            return self.length(text)
+        return prefix_length + self.kern(prefix[-1], text[0]) + self.length(text)
+
+    def joined_right(self, prefix_length: float, prefix: str, text: str) -> int:
+        # right ink edge of prefix + text, given the advance of prefix
+        if not prefix:
+            return self.bbox(text)[2]
+        return math.ceil(
+            prefix_length + self.kern(prefix[-1], text[0]) + self.bbox(text)[2] - 1e-6
+        )
+
+    def prefix_lengths(self, text: str) -> list[float]:
+        lengths = [0.0]
+        for i, char in enumerate(text):
+            lengths.append(self.joined_length(lengths[-1], text[i - 1 : i], char))
+        return lengths
+
+
+_measurers = {}
+
+
+def get_measurer(font) -> TextMeasurer:
+    key = (getattr(font, "path", None), getattr(font, "size", None), id(font))
+    if key[0] is not None:
+        key = key[:2]
+    measurer = _measurers.get(key)
+    if measurer is None:
+        measurer = _measurers[key] = TextMeasurer(font)
+    return measurer
+
+
+def wrap_text(text, font, max_width):
+    measurer = get_measurer(font)
+
     def ellipsize(word):
         ellipsis = "..."
-        ellipsis_width = draw.textbbox((0, 0), ellipsis, font=font)[2]
+        ellipsis_width = measurer.bbox(ellipsis)[2]
         if ellipsis_width > max_width:
             return ""
-        truncated = ""
-        for char in word:
-            test_word = truncated + char + ellipsis
-            test_width = draw.textbbox((0, 0), test_word, font=font)[2]
+        prefix_lengths = measurer.prefix_lengths(word)
+        lo, hi = 0, len(word)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            test_width = measurer.joined_right(
+                prefix_lengths[mid], word[mid - 1 : mid], ellipsis
+            )
             if test_width <= max_width:
-                truncated += char
+                lo = mid
             else:
-                break
-        return truncated + ellipsis
+                hi = mid - 1
+        return word[:lo] + ellipsis
 
     lines = []
     for para in text.split("\n"):
         words = para.split(" ")
         line = ""
+        line_length, line_left, line_right = 0.0, 0, 0
         for w in words:
-            w_width = draw.textbbox((0, 0), w, font=font)[2]
+            w_width = measurer.bbox(w)[2]
             if w_width > max_width:
                 w = ellipsize(w)
             test_line = (line + " " + w).strip()
-            test_box = draw.textbbox((0, 0), test_line, font=font)
-            if test_box[2] - test_box[0] <= max_width:
+            if test_line == line:
+                test_length, test_left, test_right = line_length, line_left, line_right
+            elif line and test_line == line + " " + w:
+                space_length = measurer.joined_length(line_length, line, " ")
+                test_length = measurer.joined_length(space_length, " ", w)
+                test_left = line_left
+                test_right = measurer.joined_right(space_length, " ", w)
+            else:
+                test_length = measurer.length(test_line)
+                test_left, _, test_right, _ = measurer.bbox(test_line)
+            if test_right - test_left <= max_width:
                 line = test_line
+                line_length, line_left, line_right = test_length, test_left, test_right
             else:
                 if line:
                     lines.append(line)
                 line = w
+                line_length = measurer.length(w)
+                line_left, _, line_right, _ = measurer.bbox(w)
         if line:
             lines.append(line)
     return "\n".join(lines)
 
 
-def render_conversation(
-    messages: list[TextMessage],
-    color_data_left,
-    color_data_right,
-    background_hex,
-    output_path="output.png",
-):
-    base_w = 320
-    scale = 4
-    img_w = base_w * scale
-
-    font = ImageFont.truetype("Arial.ttf", 14 * scale)
-    pad = 12 * scale
-    line_sp = 6 * scale
-    radius = 16 * scale
-    badge_sz = 36 * scale
-    badge_margin = 42 * scale
-
-    max_bubble_w = int(img_w * 0.75)
-
-    dummy = Image.new("RGB", (1, 1))
-    dd = ImageDraw.Draw(dummy)
-    wrapped, dims = [], []
-    with Pilmoji(dummy, source=AppleEmojiSource) as pilmoji:
-        for m in messages:
-            txt = wrap_text(m.content, dd, font, max_bubble_w - 2 * pad)
-            wrapped.append(txt)
-            w, h = pilmoji.getsize(txt, font=font, spacing=line_sp)
-            dims.append((w, h))
-
-    total_h = pad
-    for i, (w, h) in enumerate(dims):
-        bh = h + 2 * pad
-        total_h += bh
-        if i < len(dims) - 1:
-            next_spacing = (
-                pad // 5
-                if messages[i + 1].side == messages[i].side
-                else int(pad * 0.67)
-            )
-            total_h += next_spacing
-    total_h += pad
+EMOJI_CACHE_DIR = os.path.join(CACHE_DIR, "emoji")
+EMOJI_FETCH_WORKERS = 8
+EMOJI_FETCH_TIMEOUT = 5
+
+
+class CachedEmojiSource(BaseSource):
+    # Serves emoji from memory, then from a content-addressed store in
+    # .cache/emoji (index.json maps emoji -> sha256 of the PNG), and only
+    # then from the upstream CDN. Images are pre-scaled to `width` so
+    # Pilmoji's own resize becomes a copy. A failed fetch yields None, which
+    # makes Pilmoji fall back to drawing the character with the font.
+    def __init__(self, width: int | None = None, upstream: BaseSource | None = None):
+        self.width = width
+        if upstream is None:
+            upstream = AppleEmojiSource()
+            upstream.REQUEST_KWARGS = {
+                **AppleEmojiSource.REQUEST_KWARGS,
+                "timeout": EMOJI_FETCH_TIMEOUT,
+            }
+        self.upstream = upstream
+        self._scaled = {}
+        self._lock = threading.Lock()
+        self._index = None
 
-    bg_rgba = ImageColor.getcolor(background_hex, "RGBA")
+    def _index_path(self) -> str:
+        return os.path.join(EMOJI_CACHE_DIR, "index.json")
 
-    img_bg = Image.new("RGBA", (img_w, total_h), bg_rgba)
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(EMOJI_CACHE_DIR, "blobs", f"{digest}.png")
 
-    bubble_layer = Image.new("RGBA", (img_w, total_h), (0, 0, 0, 0))
+    def _load_index(self) -> dict:
+        if self._index is None:
+            try:
+                with open(self._index_path(), "r", encoding="utf-8") as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._index = {}
+        return self._index
+
+    def _read_disk(self, emoji: str) -> bytes | None:
+        with self._lock:
+            digest = self._load_index().get(emoji)
+        if digest is None:
+            return None
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, emoji: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            os.makedirs(os.path.dirname(self._blob_path(digest)), exist_ok=True)
+            if not os.path.exists(self._blob_path(digest)):
+                with open(self._blob_path(digest), "wb") as f:
+                    f.write(data)
+            with self._lock:
+                self._load_index()[emoji] = digest
+                tmp_path = self._index_path() + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self._index, f)
+                os.replace(tmp_path, self._index_path())
+        except OSError as e:
+            print(f"[!] Could not cache emoji {emoji}: {e}")
+
+    def _fetch(self, emoji: str) -> bytes | None:
+        data = self._read_disk(emoji)
+        if data is None:
+            try:
+                stream = self.upstream.get_emoji(emoji)
+            except Exception as e:
+                print(f"[!] Could not fetch emoji {emoji}: {e}")
+                return None
+            data = stream.getvalue() if stream else None
+            if not data:
+                return None
+            self._write_disk(emoji, data)
+        return data
+
+    def _prescale(self, data: bytes) -> bytes | None:
+        try:
+            with Image.open(io.BytesIO(data)) as asset:
+                asset = asset.convert("RGBA")
+                if self.width:
+                    # same size Pilmoji computes, so its resize is a no-op
+                    size = self.width, round(
+                        math.ceil(asset.height / asset.width * self.width)
+                    )
+                    asset = asset.resize(size, Image.Resampling.LANCZOS)
+                out = io.BytesIO()
+                asset.save(out, "PNG", compress_level=0)
+                return out.getvalue()
+        except IOError:
+            return None
+
+    def _load(self, emoji: str) -> bytes | None:
+        with self._lock:
+            if emoji in self._scaled:
+                return self._scaled[emoji]
+        data = self._fetch(emoji)
+        scaled = self._prescale(data) if data else None
+        with self._lock:
+            self._scaled[emoji] = scaled
+        return scaled
+
+    def prefetch(self, texts):
+        emojis = {
+            node.content
+            for text in texts
+            for line in to_nodes(text)
+            for node in line
+            if node.type is NodeType.emoji
+        }
+        with self._lock:
+            missing = [e for e in emojis if e not in self._scaled]
+        if missing:
+            with ThreadPoolExecutor(
+                max_workers=min(EMOJI_FETCH_WORKERS, len(missing))
+            ) as pool:
+                list(pool.map(self._load, missing))
+
+    def get_emoji(self, emoji: str, /) -> io.BytesIO | None:
+        data = self._load(emoji)
+        return io.BytesIO(data) if data else None
+
+    def get_discord_emoji(self, id: int, /) -> io.BytesIO | None:
+        return None
+
+
+@functools.cache
+def emoji_source(width: int | None = None) -> CachedEmojiSource:
+    return CachedEmojiSource(width)
+
+
+CONVO_SCALE = 4
+CONVO_EMOJI_SCALE = 1.3
+CONVO_WIDTH = 320 * CONVO_SCALE
+CONVO_PAD = 12 * CONVO_SCALE
+CONVO_LINE_SPACING = 6 * CONVO_SCALE
+CONVO_RADIUS = 16 * CONVO_SCALE
+CONVO_BADGE_SIZE = 36 * CONVO_SCALE
+CONVO_BADGE_MARGIN = 42 * CONVO_SCALE
+CONVO_MAX_BUBBLE_WIDTH = int(CONVO_WIDTH * 0.75)
+
+
+@functools.cache
+def conversation_font():
+    return ImageFont.truetype("Arial.ttf", 14 * CONVO_SCALE)
+
+
+def conversation_emoji_source() -> CachedEmojiSource:
+    return emoji_source(round(CONVO_EMOJI_SCALE * conversation_font().size))
+
+
+@dataclass(frozen=True)
+class TextRun:
+    text: str
+    width: int
+    height: int
+
+
+@dataclass(frozen=True)
+class BubbleLayout:
+    side: str
+    unsent: bool
+    rect: tuple[int, int, int, int]
+    # polygon for a normal tail, two ellipse boxes for an unsent message
+    tail: tuple[tuple[int, ...], ...]
+    text_pos: tuple[int, int]
+    text: TextRun
+    badge_pos: tuple[int, int]
+    emoji_offset: int
+
+
+@dataclass(frozen=True)
+class ConversationLayout:
+    width: int
+    height: int
+    bubbles: tuple[BubbleLayout, ...]
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ConversationLayout":
+        return cls(
+            width=data["width"],
+            height=data["height"],
+            bubbles=tuple(
+                BubbleLayout(
+                    side=b["side"],
+                    unsent=b["unsent"],
+                    rect=tuple(b["rect"]),
+                    tail=tuple(tuple(p) for p in b["tail"]),
+                    text_pos=tuple(b["text_pos"]),
+                    text=TextRun(**b["text"]),
+                    badge_pos=tuple(b["badge_pos"]),
+                    emoji_offset=b["emoji_offset"],
+                )
+                for b in data["bubbles"]
+            ),
+        )
 
-    text_drawings = []
 
-    y = pad
-    text_offset = int(0 * scale)
-    for i, (m, txt, (w, h)) in enumerate(zip(messages, wrapped, dims)):
-        bw = w + 2 * pad
-        bh = h + 2 * pad
-        if m.side == "left":
-            x0 = pad
-            badge_x = x0 + bw - badge_sz + badge_margin
-            bubble_color = color_data_left["bubble_hex"]
-            text_hex = color_data_left["text_hex"]
-        else:
-            x0 = img_w - bw - pad
-            badge_x = x0 - badge_margin
-            bubble_color = color_data_right["bubble_hex"]
-            text_hex = color_data_right["text_hex"]
+def measure_text_run(pilmoji, content: str) -> TextRun:
+    font = conversation_font()
+    txt = wrap_text(content, font, CONVO_MAX_BUBBLE_WIDTH - 2 * CONVO_PAD)
+    w, h = pilmoji.getsize(txt, font=font, spacing=CONVO_LINE_SPACING)
+    return TextRun(txt, w, h)
 
-        x1, y1 = x0 + bw, y + bh
 
-        bubble_draw = ImageDraw.Draw(bubble_layer)
-        if m.unsent:
-            if m.side == "left":
-                center_big = (x0 + 5 * scale, y1 - 5 * scale)
-                big_rad = 7 * scale
-                bbox_big = (
-                    center_big[0] - big_rad,
-                    center_big[1] - big_rad,
-                    center_big[0] + big_rad,
-                    center_big[1] + big_rad,
-                )
-                bubble_draw.ellipse(bbox_big, fill=bubble_color)
+def layout_conversation(
+    messages: list[TextMessage], text_runs: list[TextRun] | None = None
+) -> ConversationLayout:
+    scale, pad = CONVO_SCALE, CONVO_PAD
+    badge_sz, badge_margin = CONVO_BADGE_SIZE, CONVO_BADGE_MARGIN
+    img_w = CONVO_WIDTH
 
-                center_small = (x0 - 3 * scale, y1 + 3 * scale)
-                small_rad = 3 * scale
-                bbox_small = (
-                    center_small[0] - small_rad,
-                    center_small[1] - small_rad,
-                    center_small[0] + small_rad,
-                    center_small[1] + small_rad,
-                )
-                bubble_draw.ellipse(bbox_small, fill=bubble_color)
+    bubbles = []
+    y = pad
+    measuring = (
+        Pilmoji(Image.new("RGB", (1, 1)), source=conversation_emoji_source())
+        if text_runs is None
+        else nullcontext()
+    )
+    with measuring as pilmoji:
+        for i, m in enumerate(messages):
+            run = measure_text_run(pilmoji, m.content) if pilmoji else text_runs[i]
+            if i > 0:
+                y += pad // 5 if messages[i - 1].side == m.side else int(pad * 0.67)
+
+            bw = run.width + 2 * pad
+            bh = run.height + 2 * pad
+            if m.side == "left":
+                x0 = pad
+                badge_x = x0 + bw - badge_sz + badge_margin
             else:
-                center_big = (x1 - 5 * scale, y1 - 5 * scale)
-                big_rad = 7 * scale
-                bbox_big = (
-                    center_big[0] - big_rad,
-                    center_big[1] - big_rad,
-                    center_big[0] + big_rad,
-                    center_big[1] + big_rad,
-                )
-                bubble_draw.ellipse(bbox_big, fill=bubble_color)
+                x0 = img_w - bw - pad
+                badge_x = x0 - badge_margin
+            x1, y1 = x0 + bw, y + bh
 
-                center_small = (x1 + 3 * scale, y1 + 3 * scale)
+            if m.unsent:
+                edge, inward = (x0, 1) if m.side == "left" else (x1, -1)
+                center_big = (edge + inward * 5 * scale, y1 - 5 * scale)
+                big_rad = 7 * scale
+                center_small = (edge - inward * 3 * scale, y1 + 3 * scale)
                 small_rad = 3 * scale
-                bbox_small = (
-                    center_small[0] - small_rad,
-                    center_small[1] - small_rad,
-                    center_small[0] + small_rad,
-                    center_small[1] + small_rad,
+                tail = (
+                    (
+                        center_big[0] - big_rad,
+                        center_big[1] - big_rad,
+                        center_big[0] + big_rad,
+                        center_big[1] + big_rad,
+                    ),
+                    (
+                        center_small[0] - small_rad,
+                        center_small[1] - small_rad,
+                        center_small[0] + small_rad,
+                        center_small[1] + small_rad,
+                    ),
                 )
-                bubble_draw.ellipse(bbox_small, fill=bubble_color)
-        else:
-            if m.side == "left":
-                tail = [
+            elif m.side == "left":
+                tail = (
                     (x0 + 2 * scale, y + bh - 16 * scale),
                     (x0 - 6 * scale, y + bh),
                     (x0 + 10 * scale, y + bh - 4 * scale),
-                ]
-                bubble_draw.polygon(tail, fill=bubble_color)
+                )
             else:
-                tail = [
+                tail = (
                     (x1 - 2 * scale, y + bh - 16 * scale),
                     (x1 + 6 * scale, y + bh),
                     (x1 - 10 * scale, y + bh - 4 * scale),
-                ]
-                bubble_draw.polygon(tail, fill=bubble_color)
-        bubble_draw.rounded_rectangle((x0, y, x1, y1), radius, fill=bubble_color)
-
-        text_drawings.append(
-            (
-                (x0 + pad, y + pad - text_offset),
-                txt,
-                font,
-                text_hex,
-                line_sp,
-                -10 if m.side == "left" else 10,
+                )
+
+            bubbles.append(
+                BubbleLayout(
+                    side=m.side,
+                    unsent=m.unsent,
+                    rect=(x0, y, x1, y1),
+                    tail=tail,
+                    text_pos=(x0 + pad, y + pad),
+                    text=run,
+                    badge_pos=(badge_x, y + (bh - badge_sz) // 2),
+                    emoji_offset=-10 if m.side == "left" else 10,
+                )
             )
-        )
+            y = y1
 
-        badge = Image.open(
-            m.classification.png_path("white" if m.side == "right" else "black")
-        ).resize((badge_sz, badge_sz))
-        if badge.mode != "RGBA":
-            badge = badge.convert("RGBA")
-        by = y + (bh - badge_sz) // 2
-        img_bg.paste(badge, (badge_x, by), badge)
-
-        spacing = (
-            pad // 5
-            if (i < len(messages) - 1 and messages[i + 1].side == m.side)
-            else int(pad * 0.67)
+    return ConversationLayout(width=img_w, height=y + pad, bubbles=tuple(bubbles))
+
+
+def conversation_text_drawings(
+    layout: ConversationLayout, color_data_left, color_data_right
+):
+    return [
+        (
+            b.text_pos,
+            b.text.text,
+            (color_data_left if b.side == "left" else color_data_right)["text_hex"],
+            b.emoji_offset,
         )
-        y += bh + spacing
+        for b in layout.bubbles
+    ]
 
-    composite_img = Image.alpha_composite(img_bg, bubble_layer)
 
-    with Pilmoji(composite_img, source=AppleEmojiSource) as pilmoji:
-        for pos, t, f, col, sp, offs in text_drawings:
+def draw_conversation_text(img, text_drawings):
+    source = conversation_emoji_source()
+    source.prefetch(text for _, text, _, _ in text_drawings)
+    with Pilmoji(img, source=source) as pilmoji:
+        for pos, text, fill, offset in text_drawings:
             pilmoji.text(
                 pos,
-                t,
-                font=f,
-                fill=col,
-                spacing=sp,
-                emoji_scale_factor=1.3,
-                emoji_position_offset=(offs, 0),
+                text,
+                font=conversation_font(),
+                fill=fill,
+                spacing=CONVO_LINE_SPACING,
+                emoji_scale_factor=CONVO_EMOJI_SCALE,
+                emoji_position_offset=(offset, 0),
             )
 
-    final_img = composite_img.convert("RGB")
+
+def draw_conversation_base(
+    layout: ConversationLayout, color_data_left, color_data_right, background_hex
+):
+    # Badges go between the background and the bubbles, and a badge can
+    # reach under the next bubble when its own bubble is shorter than it. The
+    # base keeps the bubble layer's alpha so draw_badges can paste the badges
+    # and then lay the bubbles and their text back over them.
+    bg_rgba = ImageColor.getcolor(background_hex, "RGBA")
+    img_bg = Image.new("RGBA", (layout.width, layout.height), bg_rgba)
+    bubble_layer = Image.new("RGBA", (layout.width, layout.height), (0, 0, 0, 0))
+    bubble_draw = ImageDraw.Draw(bubble_layer)
+
+    for b in layout.bubbles:
+        color_data = color_data_left if b.side == "left" else color_data_right
+        bubble_color = color_data["bubble_hex"]
+        if b.unsent:
+            for bbox in b.tail:
+                bubble_draw.ellipse(bbox, fill=bubble_color)
+        else:
+            bubble_draw.polygon(b.tail, fill=bubble_color)
+        bubble_draw.rounded_rectangle(b.rect, CONVO_RADIUS, fill=bubble_color)
+
+    composite_img = Image.alpha_composite(img_bg, bubble_layer)
+    bubble_alpha = bubble_layer.getchannel("A")
+
+    # Text is drawn over the badges, so when any of it lands outside the
+    # bubbles (emoji are drawn wider than they measure) the base is left
+    # without text and draw_badges draws it last.
+    text_drawings = conversation_text_drawings(
+        layout, color_data_left, color_data_right
+    )
+    ink = Image.new("RGBA", composite_img.size, (0, 0, 0, 0))
+    draw_conversation_text(ink, text_drawings)
+    spill = ink.getchannel("A")
+    spill.paste(0, mask=bubble_alpha)
+    if spill.getbbox() is None:
+        draw_conversation_text(composite_img, text_drawings)
+        text_drawings = None
+
+    composite_img.putalpha(bubble_alpha)
+    return composite_img, text_drawings
+
+
+def draw_badges(
+    base_img, layout: ConversationLayout, classifications, text_drawings=None
+):
+    img = base_img.convert("RGB")
+    for b, classification in zip(layout.bubbles, classifications):
+        badge = get_badge(
+            classification,
+            "white" if b.side == "right" else "black",
+            CONVO_BADGE_SIZE,
+            Image.BICUBIC,
+        )
+        img.paste(badge, b.badge_pos, badge)
+    img.paste(base_img, (0, 0), base_img)
+    if text_drawings:
+        draw_conversation_text(img, text_drawings)
+    return img
+
+
+LAYOUT_CACHE_DIR = os.path.join(CACHE_DIR, "layouts")
+LAYOUT_CACHE_VERSION = 1
+LAYOUT_DISK_LIMIT = 1024  # files; least recently used go first
+CONVERSATION_BASE_LIMIT = 16
+
+_text_run_cache = {}
+_conversation_bases = OrderedDict()
+_conversation_cache_lock = threading.Lock()
+
+
+def _text_runs_path(cache_key: str) -> str:
+    return os.path.join(LAYOUT_CACHE_DIR, f"{cache_key}.json")
+
+
+def load_text_runs(cache_key: str, messages: list[TextMessage]):
+    contents = [m.content for m in messages]
+    with _conversation_cache_lock:
+        cached = _text_run_cache.get(cache_key)
+    if cached is None:
+        try:
+            with open(_text_runs_path(cache_key), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        touch_cache_file(_text_runs_path(cache_key))
+        with _conversation_cache_lock:
+            _text_run_cache[cache_key] = cached
+    if (
+        cached.get("version") != LAYOUT_CACHE_VERSION
+        or cached.get("contents") != contents
+    ):
+        return None
+    return [TextRun(**run) for run in cached["runs"]]
+
+
+def save_text_runs(
+    cache_key: str, messages: list[TextMessage], layout: ConversationLayout
+):
+    cached = {
+        "version": LAYOUT_CACHE_VERSION,
+        "contents": [m.content for m in messages],
+        "runs": [asdict(b.text) for b in layout.bubbles],
+    }
+    with _conversation_cache_lock:
+        _text_run_cache[cache_key] = cached
+    try:
+        os.makedirs(LAYOUT_CACHE_DIR, exist_ok=True)
+        with open(_text_runs_path(cache_key), "w", encoding="utf-8") as f:
+            json.dump(cached, f)
+        prune_cache_dir(LAYOUT_CACHE_DIR, LAYOUT_DISK_LIMIT)
+    except OSError as e:
+        print(f"[!] Could not cache layout for {cache_key}: {e}")
+
+
+def cached_layout(cache_key: str, messages: list[TextMessage]) -> ConversationLayout:
+    text_runs = load_text_runs(cache_key, messages)
+    layout = layout_conversation(messages, text_runs)
+    if text_runs is None:
+        save_text_runs(cache_key, messages, layout)
+    return layout
+
+
+def conversation_base(
+    cache_key: str,
+    messages: list[TextMessage],
+    color_data_left,
+    color_data_right,
+    background_hex,
+):
+    # Text runs don't depend on sides, so flipped annotations still skip text
+    # shaping; the drawn base is cached per contents, side/unsent pattern and
+    # colors.
+    contents = json.dumps([m.content for m in messages], ensure_ascii=False)
+    key = (
+        cache_key,
+        hashlib.sha256(contents.encode("utf-8")).hexdigest(),
+        tuple((m.side, m.unsent) for m in messages),
+        json.dumps([color_data_left, color_data_right, background_hex]),
+    )
+    with _conversation_cache_lock:
+        if key in _conversation_bases:
+            _conversation_bases.move_to_end(key)
+            return _conversation_bases[key]
+
+    layout = cached_layout(cache_key, messages)
+    base_img, text_drawings = draw_conversation_base(
+        layout, color_data_left, color_data_right, background_hex
+    )
+
+    with _conversation_cache_lock:
+        _conversation_bases[key] = (layout, base_img, text_drawings)
+        while len(_conversation_bases) > CONVERSATION_BASE_LIMIT:
+            _conversation_bases.popitem(last=False)
+    return layout, base_img, text_drawings
+
+
+def render_conversation(
+    messages: list[TextMessage],
+    color_data_left,
+    color_data_right,
+    background_hex,
+    output_path="output.png",
+    cache_key: str | None = None,
+    cache_base: bool = True,
+):
+    # cache_base=False still saves the text runs under cache_key but doesn't
+    # keep the full-size drawn base in memory
+    if cache_key is not None and cache_base:
+        layout, base_img, text_drawings = conversation_base(
+            cache_key, messages, color_data_left, color_data_right, background_hex
+        )
+    else:
+        layout = (
+            layout_conversation(messages)
+            if cache_key is None
+            else cached_layout(cache_key, messages)
+        )
+        base_img, text_drawings = draw_conversation_base(
+            layout, color_data_left, color_data_right, background_hex
+        )
+    final_img = draw_badges(
+        base_img, layout, [m.classification for m in messages], text_drawings
+    )
     final_img.save(output_path)
 
 
-def wrap_text_by_width(text: str, font, max_width: int, measure_fn) -> list[str]:
+def wrap_text_by_width(text: str, font, max_width: int) -> list[str]:
+    measurer = get_measurer(font)
     lines = []
     if not text.strip():
         return []
 
+    def extent(text_to_measure):
+        if not text_to_measure:
+            return 0.0, 0, 0
+        left, _, right, _ = measurer.bbox(text_to_measure)
+        return measurer.length(text_to_measure), left, right
+
+    def split_long_word(word):
+        # prefix[k] is the advance of word[:k]; a segment's advance is a
+        # difference of two prefixes minus the kerning across its left edge.
+        prefix = measurer.prefix_lengths(word)
+
+        def segment_length(start, end):
+            length = prefix[end] - prefix[start]
+            if start > 0 and end > start:
+                length -= measurer.kern(word[start - 1], word[start])
+            return length
+
+        def segment_width(start, end):
+            last_joined = word[end - 2] if end - 1 > start else ""
+            right = measurer.joined_right(
+                segment_length(start, end - 1), last_joined, word[end - 1]
+            )
+            return right - measurer.bbox(word[start])[0]
+
+        start = 0
+        while True:
+            lo, hi = start + 1, len(word)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if segment_width(start, mid) <= max_width:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo == len(word):
+                break
+            lines.append(word[start:lo])
+            start = lo
+        last = word[start:]
+        left = measurer.bbox(last)[0]
+        return (
+            last,
+            segment_length(start, len(word)),
+            left,
+            left + segment_width(start, len(word)),
+        )
+
     for paragraph in text.split("\n"):
         words = paragraph.split(" ")
         current_line_being_built = ""
+        line_length, line_left, line_right = 0.0, 0, 0
         for word_idx, word in enumerate(words):
             if (
                 not word
@@ -424,44 +1145,154 @@ def wrap_text_by_width(text: str, font, max_width: int, measure_fn) -> list[str]
                 else word
             )
 
-            w, _ = measure_fn(test_line, font)
-            if w <= max_width:
+            if test_line == current_line_being_built:
+                test_length, test_left, test_right = line_length, line_left, line_right
+            elif (
+                current_line_being_built
+                and test_line == f"{current_line_being_built} {word}"
+            ):
+                space_length = measurer.joined_length(
+                    line_length, current_line_being_built, " "
+                )
+                test_length = measurer.joined_length(space_length, " ", word)
+                test_left = line_left
+                test_right = measurer.joined_right(space_length, " ", word)
+            else:
+                test_length, test_left, test_right = extent(test_line)
+
+            if test_right - test_left <= max_width:
                 current_line_being_built = test_line
+                line_length, line_left, line_right = test_length, test_left, test_right
             else:
                 if current_line_being_built:
                     lines.append(current_line_being_built)
 
-                word_w_itself, _ = measure_fn(word, font)
-                if word_w_itself <= max_width:
+                word_length, word_left, word_right = extent(word)
+                if word_right - word_left <= max_width:
                     current_line_being_built = word
+                    line_length, line_left, line_right = (
+                        word_length,
+                        word_left,
+                        word_right,
+                    )
                 else:
-                    sub_word_segment = ""
-                    for char_in_word in word:
-                        test_char_segment = sub_word_segment + char_in_word
-                        char_seg_w, _ = measure_fn(test_char_segment, font)
-                        if char_seg_w <= max_width:
-                            sub_word_segment = test_char_segment
-                        else:
-                            if sub_word_segment:
-                                lines.append(sub_word_segment)
-                            sub_word_segment = char_in_word
-                    current_line_being_built = sub_word_segment
+                    (
+                        current_line_being_built,
+                        line_length,
+                        line_left,
+                        line_right,
+                    ) = split_long_word(word)
 
         if current_line_being_built:
             lines.append(current_line_being_built)
     return lines
 
 
+AVATAR_CACHE_DIR = os.path.join(CACHE_DIR, "avatars")
+AVATAR_MEMORY_LIMIT = 256
+AVATAR_DISK_LIMIT = 2048  # files; least recently used go first
+AVATAR_FETCH_WORKERS = 8
+
+avatar_session = requests.Session()
+_avatar_cache = OrderedDict()
+_avatar_cache_lock = threading.Lock()
+
+
+@functools.cache
+def circle_mask(size: int):
+    # drawn at 4x and downsampled once so the edge is anti-aliased
+    hires_size = size * 4
+    mask_hires = Image.new("L", (hires_size, hires_size), 0)
+    ImageDraw.Draw(mask_hires).ellipse((0, 0, hires_size, hires_size), fill=255)
+    return mask_hires.resize((size, size), Image.LANCZOS)
+
+
+def mask_avatar(avatar_source_img, size: int, bg_color: str):
+    resized = avatar_source_img.resize((size, size), Image.LANCZOS)
+    avatar = Image.new("RGBA", (size, size), bg_color)
+    avatar.paste(resized, (0, 0), resized)
+    avatar.putalpha(circle_mask(size))
+    return avatar
+
+
+def _remember_avatar(key, avatar):
+    with _avatar_cache_lock:
+        _avatar_cache[key] = avatar
+        _avatar_cache.move_to_end(key)
+        while len(_avatar_cache) > AVATAR_MEMORY_LIMIT:
+            _avatar_cache.popitem(last=False)
+    return avatar
+
+
+def load_avatar(url: str | None, size: int, bg_color: str):
+    key = (url, size, bg_color)
+    with _avatar_cache_lock:
+        if key in _avatar_cache:
+            _avatar_cache.move_to_end(key)
+            return _avatar_cache[key]
+
+    disk_path = os.path.join(
+        AVATAR_CACHE_DIR,
+        hashlib.sha256(f"{url}|{size}|{bg_color}".encode()).hexdigest() + ".png",
+    )
+    if url and os.path.exists(disk_path):
+        try:
+            with Image.open(disk_path) as cached:
+                avatar = cached.convert("RGBA")
+            touch_cache_file(disk_path)
+            return _remember_avatar(key, avatar)
+        except IOError:
+            pass
+
+    try:
+        if not url:
+            raise IOError("no avatar url")
+        resp = avatar_session.get(url, timeout=5)
+        resp.raise_for_status()
+        avatar_source_img = Image.open(io.BytesIO(resp.content)).convert("RGBA")
+    except (requests.exceptions.RequestException, IOError):
+        # fallbacks only live in memory so a flaky fetch is retried next run
+        avatar_source_img = Image.new("RGBA", (size, size), "#888")
+        return _remember_avatar(key, mask_avatar(avatar_source_img, size, bg_color))
+
+    avatar = mask_avatar(avatar_source_img, size, bg_color)
+    try:
+        os.makedirs(AVATAR_CACHE_DIR, exist_ok=True)
+        avatar.save(disk_path)
+        prune_cache_dir(AVATAR_CACHE_DIR, AVATAR_DISK_LIMIT)
+    except OSError as e:
+        print(f"[!] Could not cache avatar {url}: {e}")
+    return _remember_avatar(key, avatar)
+
+
+def prefetch_avatars(urls, size: int, bg_color: str) -> dict:
+    unique_urls = list(dict.fromkeys(urls))
+    if not unique_urls:
+        return {}
+    with ThreadPoolExecutor(
+        max_workers=min(AVATAR_FETCH_WORKERS, len(unique_urls))
+    ) as pool:
+        avatars = pool.map(lambda url: load_avatar(url, size, bg_color), unique_urls)
+        return dict(zip(unique_urls, avatars))
+
+
+CHAIN_WIDTH = 1280
+CHAIN_SIDE_MARGIN = 45
+CHAIN_BADGE_SIZE = 144
+CHAIN_TEXT_BADGE_GAP = 30
+CHAIN_TEXT_SIZE = 64
+
+
 def render_reddit_chain(
     messages: list[TextMessage],
     output_path: str,
     *,
-    max_image_width: int = 1280,
+    max_image_width: int = CHAIN_WIDTH,
     bg_color: str = "#101214",
     username_color: str = "#8FA1AB",
     text_color: str = "#D4D7D9",
 ):
-    SIDE_MARGIN = 45
+    SIDE_MARGIN = CHAIN_SIDE_MARGIN
     TOP_MARGIN = 45
     BETWEEN_MESSAGES_VERTICAL_SPACING = 40
     BOTTOM_IMAGE_PADDING = BETWEEN_MESSAGES_VERTICAL_SPACING
@@ -473,12 +1304,12 @@ def render_reddit_chain(
 
     TEXT_LINE_LEADING = 18
 
-    BADGE_SIZE = 144
-    TEXT_BADGE_HORIZONTAL_GAP = 30
+    BADGE_SIZE = CHAIN_BADGE_SIZE
+    TEXT_BADGE_HORIZONTAL_GAP = CHAIN_TEXT_BADGE_GAP
 
     try:
         font_username = ImageFont.truetype("Arial Bold.ttf", 56)
-        font_text = ImageFont.truetype("Arial.ttf", 64)
+        font_text = ImageFont.truetype("Arial.ttf", CHAIN_TEXT_SIZE)
     except IOError:
         print("Warning: Arial fonts not found. Using default.")
         font_username = ImageFont.load_default()
@@ -509,9 +1340,7 @@ def render_reddit_chain(
             - SIDE_MARGIN
             - (BADGE_SIZE + TEXT_BADGE_HORIZONTAL_GAP + SIDE_MARGIN)
         )
-        wrapped_lines = wrap_text_by_width(
-            msg.content, font_text, max_text_width, measure
-        )
+        wrapped_lines = wrap_text_by_width(msg.content, font_text, max_text_width)
 
         text_block_height = 0
         if wrapped_lines:
@@ -521,8 +1350,7 @@ def render_reddit_chain(
                 else 0
             )
 
-        badge_path_check = msg.classification.png_path("white")
-        badge_exists_check = os.path.exists(badge_path_check)
+        badge = get_badge(msg.classification, "white", BADGE_SIZE)
 
         message_layouts.append(
             {
@@ -530,8 +1358,7 @@ def render_reddit_chain(
                 "text_block_height": text_block_height,
                 "username_width": measure(msg.username, font_username)[0],
                 "username_height": measure(msg.username, font_username)[1],
-                "badge_exists": badge_exists_check,
-                "badge_path": badge_path_check if badge_exists_check else None,
+                "badge": badge,
             }
         )
 
@@ -557,7 +1384,7 @@ def render_reddit_chain(
         )
 
         badge_draw_x = max_image_width - SIDE_MARGIN - BADGE_SIZE
-        badge_is_present = msg_layout_info["badge_exists"]
+        badge_is_present = msg_layout_info["badge"] is not None
         badge_draw_y = 0
         badge_actual_bottom_y = text_block_actual_start_y
 
@@ -598,8 +1425,7 @@ def render_reddit_chain(
                     text_block_actual_start_y,
                 ),
                 "badge_pos": (badge_draw_x, badge_draw_y),
-                "badge_exists": badge_is_present,
-                "badge_path": msg_layout_info["badge_path"],
+                "badge": msg_layout_info["badge"],
                 "content_bottom_y": current_message_content_bottom_y,
             }
         )
@@ -622,41 +1448,21 @@ def render_reddit_chain(
     )
     final_image_height = max(final_image_height, min_height_calc)
 
+    avatars = prefetch_avatars(
+        [msg.avatar_url for msg in messages], AVATAR_SIZE, bg_color
+    )
+
     canvas = Image.new("RGB", (max_image_width, int(final_image_height)), bg_color)
     draw = ImageDraw.Draw(canvas)
 
     for idx, details in enumerate(message_draw_details):
         msg_obj = messages[idx]
 
-        try:
-            resp = requests.get(msg_obj.avatar_url, timeout=5)
-            resp.raise_for_status()
-            avatar_source_img = Image.open(io.BytesIO(resp.content)).convert("RGBA")
-        except requests.exceptions.RequestException as e:
-
-            avatar_source_img = Image.new("RGBA", (AVATAR_SIZE, AVATAR_SIZE), "#888")
-        except IOError:
-
-            avatar_source_img = Image.new("RGBA", (AVATAR_SIZE, AVATAR_SIZE), "#888")
-
-        hires_avatar_size = AVATAR_SIZE * 4
-        hires_avatar = avatar_source_img.resize(
-            (hires_avatar_size, hires_avatar_size), Image.LANCZOS
-        )
-        avatar_bg_hires = Image.new(
-            "RGBA", (hires_avatar_size, hires_avatar_size), bg_color
-        )
-        avatar_bg_hires.paste(hires_avatar, (0, 0), hires_avatar)
-        mask_hires = Image.new("L", (hires_avatar_size, hires_avatar_size), 0)
-        ImageDraw.Draw(mask_hires).ellipse(
-            (0, 0, hires_avatar_size, hires_avatar_size), fill=255
-        )
-        final_avatar = avatar_bg_hires.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
-        final_mask = mask_hires.resize((AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+        avatar = avatars[msg_obj.avatar_url]
         canvas.paste(
-            final_avatar,
+            avatar,
             (int(details["avatar_pos"][0]), int(details["avatar_pos"][1])),
-            final_mask,
+            avatar,
         )
 
         draw.text(
@@ -678,21 +1484,12 @@ def render_reddit_chain(
             )
             current_text_y += TEXT_LINE_BBOX_HEIGHT + TEXT_LINE_LEADING
 
-        if details["badge_exists"] and details["badge_path"]:
-            try:
-                badge_img = Image.open(details["badge_path"]).convert("RGBA")
-                badge_img_resized = badge_img.resize(
-                    (BADGE_SIZE, BADGE_SIZE), Image.LANCZOS
-                )
-                canvas.paste(
-                    badge_img_resized,
-                    (int(details["badge_pos"][0]), int(details["badge_pos"][1])),
-                    badge_img_resized,
-                )
-            except FileNotFoundError:
-                print(f"Badge file not found: {details['badge_path']}")
-            except IOError:
-                print(f"Could not open badge: {details['badge_path']}")
+        if details["badge"] is not None:
+            canvas.paste(
+                details["badge"],
+                (int(details["badge_pos"][0]), int(details["badge_pos"][1])),
+                details["badge"],
+            )
 
     canvas.save(output_path)
     print(f"Reddit chain image saved to {output_path}")
@@ -1,85 +1,214 @@
+import hashlib
 import math
+import mimetypes
 import os
 import praw
 import requests
+import sqlite3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import tempfile
+import threading
 import time
+import unicodedata
 import json
-from google import genai
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
 from google.genai.types import EmbedContentConfig
 from datetime import datetime, timezone, timedelta
 from PIL import Image
 from pathlib import Path
-from pinecone import Pinecone
-from playwright.sync_api import sync_playwright
+from urllib.parse import quote, urljoin
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+from playwright.sync_api import expect, sync_playwright
 from texting_theory import (
+    CACHE_DIR,
     call_llm_on_image,
+    gemini_client,
     parse_llm_response,
     render_conversation,
     render_reddit_chain,
+    singleton,
     Classification,
     TextMessage,
 )
+from vector_store import LocalVectorStore, PineconeStore, VectorStore
 
-reddit = praw.Reddit(
-    client_id=os.environ["REDDIT_CLIENT_ID"],
-    client_secret=os.environ["REDDIT_SECRET"],
-    username=os.environ["REDDIT_USERNAME"],
-    password=os.environ["REDDIT_PASSWORD"],
-    user_agent="texting-theory-bot",
-)
-
-
-from google import genai
-from google.genai.types import EmbedContentConfig
 
-client = genai.Client(api_key=os.environ["GEMINI_API_KEY"])
+@singleton
+def reddit_client():
+    return praw.Reddit(
+        client_id=os.environ["REDDIT_CLIENT_ID"],
+        client_secret=os.environ["REDDIT_SECRET"],
+        username=os.environ["REDDIT_USERNAME"],
+        password=os.environ["REDDIT_PASSWORD"],
+        user_agent="texting-theory-bot",
+    )
 
 
 def get_convo_str(msgs):
     return "\n\n".join([f"{m.content}" for m in msgs])
 
 
-def get_embedding(convo_str):
-    result = client.models.embed_content(
-        model="text-embedding-004",
-        contents=convo_str,
-        config=EmbedContentConfig(
-            task_type="RETRIEVAL_DOCUMENT",
-        ),
-    )
-    return result.embeddings[0].values
+EMBEDDING_MODEL = "text-embedding-004"
+EMBEDDING_TASK_TYPE = "RETRIEVAL_DOCUMENT"
+EMBEDDING_CACHE_LIMIT = 20000  # rows kept in the state db, least recently used go first
 
 
-pc = Pinecone(api_key=os.environ["PINECONE_API_KEY"])
-index = pc.Index("texting-theory")
+def embedding_key(text, model=EMBEDDING_MODEL, task_type=EMBEDDING_TASK_TYPE):
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha256(f"{model}\0{task_type}\0{normalized}".encode()).hexdigest()
 
 
-def pinecone_insert(post_id, embedding, convo_text):
-    vector = {
-        "id": post_id,
-        "values": embedding,
-        "metadata": {"convo_text": convo_text},
+def _cached_embeddings(keys):
+    if not keys:
+        return {}
+    placeholders = ",".join("?" * len(keys))
+    with _state_db_lock:
+        db = state_db()
+        rows = db.execute(
+            f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", keys
+        ).fetchall()
+        db.execute(
+            f"UPDATE embeddings SET used_at = ? WHERE key IN ({placeholders})",
+            [time.time(), *keys],
+        )
+    return {key: array("f", vector).tolist() for key, vector in rows}
+
+
+def _store_embeddings(embeddings):
+    now = time.time()
+    with _state_db_lock:
+        db = state_db()
+        db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, used_at) VALUES (?, ?, ?)",
+            [
+                (key, array("f", values).tobytes(), now)
+                for key, values in embeddings.items()
+            ],
+        )
+        db.execute(
+            """DELETE FROM embeddings WHERE key IN (
+                SELECT key FROM embeddings ORDER BY used_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (EMBEDDING_CACHE_LIMIT,),
+        )
+
+
+def get_embeddings(convo_strs):
+    keys = [embedding_key(text) for text in convo_strs]
+    embeddings = _cached_embeddings(list(dict.fromkeys(keys)))
+    # one request for everything not cached, each distinct text once
+    missing = {
+        key: text for key, text in zip(keys, convo_strs) if key not in embeddings
     }
+    if missing:
+        result = gemini_client().models.embed_content(
+            model=EMBEDDING_MODEL,
+            contents=list(missing.values()),
+            config=EmbedContentConfig(
+                task_type=EMBEDDING_TASK_TYPE,
+            ),
+        )
+        fetched = {
+            key: embedding.values for key, embedding in zip(missing, result.embeddings)
+        }
+        _store_embeddings(fetched)
+        embeddings.update(fetched)
+    return [embeddings[key] for key in keys]
+
+
+EMBED_BATCH_WINDOW = 0.5  # longest the first caller waits for others to join
+
+
+class EmbeddingBatcher:
+    # Lets analysis workers that finish around the same time share one
+    # embed_content request. Analyses run inside expecting() until they ask
+    # for their embedding; the first caller with an uncached text waits, up
+    # to EMBED_BATCH_WINDOW, only while other analyses might still join.
+    def __init__(self, window=EMBED_BATCH_WINDOW):
+        self.window = window
+        self._cond = threading.Condition()
+        self._batch = None
+        self._expected = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def expecting(self):
+        with self._cond:
+            self._expected += 1
+        self._local.expected = True
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self):
+        if getattr(self._local, "expected", False):
+            self._local.expected = False
+            with self._cond:
+                self._expected -= 1
+                self._cond.notify_all()
+
+    def embed(self, text):
+        cached = _cached_embeddings([embedding_key(text)])
+        if cached:
+            self._release()
+            return next(iter(cached.values()))
+        with self._cond:
+            leader = self._batch is None
+            if leader:
+                self._batch = ([], Future())
+            texts, result = self._batch
+            index = len(texts)
+            texts.append(text)
+            self._release()
+            if leader:
+                self._cond.wait_for(lambda: self._expected == 0, self.window)
+                self._batch = None
+        if leader:
+            try:
+                result.set_result(get_embeddings(texts))
+            except Exception as e:
+                result.set_exception(e)
+        return result.result()[index]
+
+
+embedding_batcher = EmbeddingBatcher()
 
-    index.upsert(vectors=[vector])
-    print(f"Uploaded vector for {post_id}")
 
+VECTOR_STORE = os.getenv("VECTOR_STORE") or "pinecone"
+VECTOR_STORE_DIR = os.path.join(CACHE_DIR, "vectors")
+
+
+@singleton
+def vector_store() -> VectorStore:
+    if VECTOR_STORE == "pinecone":
+        return PineconeStore(os.environ["PINECONE_API_KEY"], "texting-theory")
+    if VECTOR_STORE == "local":
+        return LocalVectorStore(VECTOR_STORE_DIR)
+    raise ValueError(f"Unknown VECTOR_STORE: {VECTOR_STORE}")
+
+
+def vector_insert(post_id, embedding, convo_text):
+    vector_store().upsert(post_id, embedding, convo_text)
+    print(f"Uploaded vector for {post_id}")
 
-def find_similar_conversations(embedding, cur_post_id, top_k=10, min_score=0.9, max=3):
-    query_result = index.query(vector=embedding, top_k=top_k, include_metadata=True)
 
+def find_similar_conversations(embedding, cur_post_id, top_k=10, min_score=0.9):
+    # Candidates only; drop_deleted_conversations checks they're still up.
     return [
         (
             match.id,
             match.score,
-            match.metadata["convo_text"],
+            match.convo_text,
         )
-        for match in query_result.matches
-        if match.id != cur_post_id
-        and match.score >= min_score
-        and not post_is_deleted(match.id)
-    ][:max]
+        for match in vector_store().query(embedding, top_k)
+        if match.id != cur_post_id and match.score >= min_score
+    ]
 
 
 STORAGE_FILE = "reddit_storage.json"
@@ -125,29 +254,134 @@ DIGIT_TO_CLASS = {
 }
 
 
-def store_post_analysis_json(post_id: str, data: dict):
-    url = f"https://api.cloudflare.com/client/v4/accounts/{CF_ACCOUNT_ID}/storage/kv/namespaces/{KV_NAMESPACE_ID}/values/post:{post_id}"
-    headers = {
-        "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    response = requests.put(url, headers=headers, data=json.dumps(data))
-    if not response.ok:
-        raise Exception(
-            f"KV store failed for post:{post_id} — {response.status_code}: {response.text}"
+CF_API_BASE = os.getenv("CF_API_BASE", "https://api.cloudflare.com/client/v4")
+KV_TIMEOUT = 15
+KV_READ_WORKERS = 8
+KV_BULK_LIMIT = 10000  # Cloudflare's cap on pairs per bulk write
+
+
+class KVClient:
+    # One pooled session for the run. Reads go through an in-memory cache
+    # (misses included), writes are queued and sent with the bulk endpoint on
+    # flush(), and queued values are visible to reads before they're flushed.
+    def __init__(
+        self,
+        account_id=CF_ACCOUNT_ID,
+        namespace_id=KV_NAMESPACE_ID,
+        api_token=CLOUDFLARE_API_TOKEN,
+        base_url=CF_API_BASE,
+    ):
+        self.url = (
+            f"{base_url}/accounts/{account_id}/storage/kv/namespaces/{namespace_id}"
         )
-    print(f"Stored post:{post_id} to KV")
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_token}"
+        adapter = HTTPAdapter(
+            pool_maxsize=KV_READ_WORKERS,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None,  # KV puts are idempotent
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._pending = {}
+
+    def get_json(self, key):
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key in self._cache:
+                return self._cache[key]
+        response = self.session.get(
+            f"{self.url}/values/{quote(key, safe='')}", timeout=KV_TIMEOUT
+        )
+        if response.status_code == 404:
+            value = None
+        else:
+            response.raise_for_status()
+            value = response.json()
+        with self._lock:
+            self._cache[key] = value
+        return value
+
+    def get_many(self, keys):
+        # A key whose read fails is logged and left out of the result instead
+        # of failing the batch; it isn't cached, so get_json retries it.
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+
+        def fetch(key):
+            try:
+                return key, self.get_json(key), None
+            except Exception as e:
+                return key, None, e
+
+        values = {}
+        with ThreadPoolExecutor(max_workers=min(KV_READ_WORKERS, len(keys))) as pool:
+            for key, value, error in pool.map(fetch, keys):
+                if error is None:
+                    values[key] = value
+                else:
+                    print(f"[!] KV read failed for {key}: {error}")
+        return values
+
+    def put_json(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), KV_BULK_LIMIT):
+            chunk = items[start : start + KV_BULK_LIMIT]
+            response = self.session.put(
+                f"{self.url}/bulk",
+                json=[{"key": key, "value": json.dumps(value)} for key, value in chunk],
+                timeout=KV_TIMEOUT,
+            )
+            if not response.ok:
+                with self._lock:
+                    for key, value in items[start:]:
+                        self._pending.setdefault(key, value)
+                raise Exception(
+                    f"KV bulk write failed for {len(items) - start} keys — {response.status_code}: {response.text}"
+                )
+            with self._lock:
+                self._cache.update(chunk)
+        if items:
+            print(f"Stored {len(items)} keys to KV")
+
+
+@singleton
+def kv_client():
+    return KVClient()
+
+
+def store_post_analysis_json(post_id: str, data: dict):
+    kv_client().put_json(f"post:{post_id}", data)
+    print(f"Queued post:{post_id} for KV")
+
+
+def flush_kv():
+    # failed writes stay queued for the next flush
+    try:
+        kv_client().flush()
+    except Exception as e:
+        print(f"[!] {e}")
 
 
 def get_post_json_from_kv(post_id):
-    url = f"https://api.cloudflare.com/client/v4/accounts/{CF_ACCOUNT_ID}/storage/kv/namespaces/{KV_NAMESPACE_ID}/values/post:{post_id}"
-    headers = {"Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}"}
-    response = requests.get(url, headers=headers)
-    if response.status_code == 404:
+    data = kv_client().get_json(f"post:{post_id}")
+    if data is None:
         print(f"[!] Post {post_id} not found in KV.")
-        return None
-    response.raise_for_status()
-    return response.json()
+    return data
 
 
 def get_recent_posts():
@@ -155,25 +389,57 @@ def get_recent_posts():
     cutoff = now - timedelta(minutes=360)
     return [
         post
-        for post in reddit.subreddit("TextingTheory").new(limit=10)
+        for post in reddit_client().subreddit("TextingTheory").new(limit=10)
         # if datetime.fromtimestamp(post.created_utc, tz=timezone.utc) > cutoff
     ]
 
 
 def get_top_posts():
-    return [
-        post
-        for post in reddit.subreddit("TextingTheory").top(time_filter="week", limit=10)
-    ]
+    subreddit = reddit_client().subreddit("TextingTheory")
+    return [post for post in subreddit.top(time_filter="week", limit=10)]
 
 
 def get_post_by_id(post_id):
-    return reddit.submission(id=post_id)
+    return reddit_client().submission(id=post_id)
+
+
+POST_INFO_TTL = 600  # seconds
+
+_post_info = {}  # post id -> (fetched at, submission or None if gone)
+_post_info_lock = threading.Lock()
+
+
+def fetch_posts(post_ids, max_age=POST_INFO_TTL):
+    post_ids = list(dict.fromkeys(post_ids))
+    now = time.monotonic()
+    with _post_info_lock:
+        missing = [
+            pid
+            for pid in post_ids
+            if pid not in _post_info or now - _post_info[pid][0] > max_age
+        ]
+    if missing:
+        # praw sends up to 100 fullnames per request
+        fullnames = [f"t3_{pid}" for pid in missing]
+        found = {s.id: s for s in reddit_client().info(fullnames=fullnames)}
+        with _post_info_lock:
+            for pid in missing:
+                _post_info[pid] = (now, found.get(pid))
+    with _post_info_lock:
+        return {pid: _post_info[pid][1] for pid in post_ids}
+
+
+def submission_is_deleted(submission):
+    return submission is None or (
+        submission.author is None and not submission.is_robot_indexable
+    )
 
 
-def post_is_deleted(post_id):
-    submission = get_post_by_id(post_id)
-    return submission.author is None and not submission.is_robot_indexable
+def post_title(post_id):
+    submission = fetch_posts([post_id])[post_id]
+    if submission is None:
+        return get_post_by_id(post_id).title
+    return submission.title
 
 
 def apply_annotation_code(
@@ -235,7 +501,7 @@ def upload_image_to_imgur(image_path):
         return r.json()["data"]["link"]
 
 
-def format_counts(messages, color_left, color_right, elo_left, elo_right):
+def count_classifications(messages):
     counts = {c: [0, 0] for c in HUMANIZED_ORDER}
     has_message = [False, False]
     for m in messages:
@@ -245,6 +511,11 @@ def format_counts(messages, color_left, color_right, elo_left, elo_right):
             counts[m.classification][idx] += 1
         elif m.classification is Classification.FORCED:
             counts[Classification.GOOD][idx] += 1
+    return counts, has_message
+
+
+def format_counts(messages, color_left, color_right, elo_left, elo_right):
+    counts, has_message = count_classifications(messages)
 
     lines = []
     lines.append(
@@ -283,6 +554,254 @@ def eval_to_emoji_squares(eval_abs, total_squares: int = 16, max_pawn: float = 4
     return b_squares, w_squares
 
 
+LOSS_RESULTS = [
+    Classification.CHECKMATED,
+    Classification.ABANDON,
+    Classification.RESIGN,
+    Classification.TIMEOUT,
+]
+
+
+def format_eval_bar(messages, evaluation, total_squares: int = 16):
+    left_classifications, right_classifications = [
+        m.classification for m in messages if m.side == "left"
+    ], [m.classification for m in messages if m.side == "right"]
+    if any(loss_result in left_classifications for loss_result in LOSS_RESULTS):
+        b_squares, w_squares = 0, total_squares
+        eval_str = "1-0"
+        eval_str_right = True
+    elif any(loss_result in right_classifications for loss_result in LOSS_RESULTS):
+        b_squares, w_squares = total_squares, 0
+        eval_str = "0-1"
+        eval_str_right = False
+    elif (
+        Classification.DRAW in left_classifications
+        or Classification.DRAW in right_classifications
+    ):
+        b_squares, w_squares = total_squares // 2, total_squares // 2
+        eval_str = "½-½"
+        eval_str_right = True
+    elif evaluation[0] == "M":
+        b_squares, w_squares = 0, total_squares
+        eval_str = evaluation
+        eval_str_right = True
+    elif evaluation[0] == "m":
+        b_squares, w_squares = total_squares, 0
+        eval_str = evaluation.upper()
+        eval_str_right = False
+    else:
+        evaluation = float(evaluation)
+        eval_str_right = evaluation >= 0
+        evaluation = abs(evaluation)
+        eval_str = f"{evaluation:.1f}" if evaluation < 10 else f"{evaluation:.0f}"
+
+        b_squares, w_squares = eval_to_emoji_squares(evaluation, total_squares)
+        if not eval_str_right:
+            b_squares, w_squares = w_squares, b_squares
+
+    eval_bar = BLACK_SQUARE * b_squares + WHITE_SQUARE * w_squares
+    if eval_str_right:
+        return eval_bar + eval_str
+    return eval_str + eval_bar
+
+
+def format_best_continuation(messages, best_continuation):
+    if best_continuation != "Resign":
+        best_continuation = f'"{best_continuation}"'
+    if messages and messages[-1].unsent:
+        return f"Suggested alternative: {best_continuation}"
+    return f"Best continuation: {best_continuation}"
+
+
+ABOUT_LINKS = [
+    (
+        "about the bot",
+        "https://www.reddit.com/r/TextingTheory/comments/1k8fed9/utextingtheorybot/",
+    ),
+    (
+        "what do the symbols mean?",
+        "https://www.reddit.com/r/TextingTheory/comments/1ksad21/classifications_badges_explained/",
+    ),
+    (
+        "!annotate",
+        "https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/",
+    ),
+]
+
+
+class BrowserSession:
+    # One warm Chromium + logged-in context shared by every comment in a run.
+    # Started on first use, restarted if the browser dies, and the refreshed
+    # storage state is written back to STORAGE_FILE on close.
+    def __init__(self, storage_file=STORAGE_FILE, headless=False):
+        self.storage_file = storage_file
+        self.headless = headless
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._page = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _start(self):
+        if not Path(self.storage_file).exists():
+            raise FileNotFoundError(f"No Reddit session at {self.storage_file}")
+        print("Loading existing session...")
+        self._playwright = sync_playwright().start()
+        try:
+            self._browser = self._playwright.chromium.launch(headless=self.headless)
+            self._context = self._browser.new_context(
+                viewport={"width": 1600, "height": 900},
+                storage_state=self.storage_file,
+            )
+        except Exception:
+            # don't leave a driver running for the next page() to stack on
+            self._shutdown()
+            raise
+
+    def _shutdown(self):
+        try:
+            if self._browser is not None:
+                self._browser.close()
+        except Exception as e:
+            print(f"[!] Error closing browser: {e}")
+        try:
+            if self._playwright is not None:
+                self._playwright.stop()
+        except Exception as e:
+            print(f"[!] Error stopping playwright: {e}")
+        self._playwright = self._browser = self._context = self._page = None
+
+    def alive(self):
+        return self._browser is not None and self._browser.is_connected()
+
+    def restart(self):
+        print("Restarting browser...")
+        self._shutdown()
+        self._start()
+
+    def page(self):
+        if not self.alive():
+            if self._browser is not None:
+                self.restart()
+            else:
+                self._start()
+        if self._page is None or self._page.is_closed():
+            self._page = self._context.new_page()
+            # leaving a half-written comment must not block the next goto
+            self._page.on("dialog", lambda dialog: dialog.accept())
+            self._page.on("crash", lambda _: self.discard_page())
+        return self._page
+
+    def discard_page(self):
+        page, self._page = self._page, None
+        if page is not None and self.alive():
+            try:
+                page.close()
+            except Exception:
+                pass
+
+    def save_storage(self):
+        if self.alive():
+            self._context.storage_state(path=self.storage_file)
+
+    def close(self):
+        try:
+            self.save_storage()
+        except Exception as e:
+            print(f"[!] Could not save Reddit session: {e}")
+        self._shutdown()
+
+
+COMPOSER_EDITOR = 'shreddit-composer div[contenteditable="true"]'
+COMMENT_SUBMIT = 'button[slot="submit-button"][type="submit"]'
+
+
+# The composer is driven off DOM state instead of fixed sleeps: Playwright's
+# click already scrolls into view and waits for the element to be stable and
+# enabled, text goes in with a single insert_text per block, and the waits
+# below only block until the editor reflects the previous step.
+def toolbar_button(page, icon_name):
+    return page.locator(f'button:has(svg[icon-name="{icon_name}"])')
+
+
+def click_when_ready(locator, timeout=5000):
+    locator.wait_for(state="visible", timeout=timeout)
+    locator.click(timeout=timeout)
+
+
+def write_line(page, text):
+    for i, line in enumerate(text.split("\n")):
+        if i:
+            page.keyboard.press("Enter")
+        if line:
+            page.keyboard.insert_text(line)
+    page.keyboard.press("Enter")
+
+
+def wait_for_state(locator, state, timeout=5000):
+    # soft wait: a selector drifting on Reddit's side should slow the
+    # composer down, not abort a half-written comment
+    try:
+        locator.wait_for(state=state, timeout=timeout)
+        return True
+    except PlaywrightTimeoutError:
+        print(f"[!] Timed out waiting for {locator} to be {state}")
+        return False
+
+
+def wait_for_count(locator, count, timeout=5000):
+    try:
+        expect(locator).to_have_count(count, timeout=timeout)
+        return True
+    except AssertionError:
+        print(f"[!] Timed out waiting for {count} of {locator}")
+        return False
+
+
+def attach_image(page, file_path):
+    images = page.locator(COMPOSER_EDITOR).last.locator("img")
+    existing = images.count()
+    with page.expect_file_chooser() as fc_info:
+        click_when_ready(toolbar_button(page, "image-post-outline"))
+    fc_info.value.set_files(file_path)
+    wait_for_count(images, existing + 1, timeout=15000)
+
+
+def insert_link(page, text, url):
+    click_when_ready(toolbar_button(page, "link-outline"))
+    save_link_button = page.get_by_test_id("btn-save-link")
+    save_link_button.wait_for(state="visible", timeout=5000)
+    page.keyboard.press("Tab")
+    page.keyboard.insert_text(text)
+    page.keyboard.press("Tab")
+    page.keyboard.insert_text(url)
+    save_link_button.click()
+    wait_for_state(save_link_button, "hidden")
+
+
+def submit_comment(page, timeout=5000):
+    comment_submit = page.locator(COMMENT_SUBMIT)
+    comment_submit.wait_for(state="visible", timeout=timeout)
+    clicked = False
+    try:
+        with page.expect_response(
+            lambda r: r.request.method == "POST" and "comment" in r.url,
+            timeout=15000,
+        ):
+            comment_submit.click()
+            clicked = True
+    except PlaywrightTimeoutError:
+        if not clicked:
+            raise
+        # the click went through; retrying here could double-post
+        print("[!] No response seen for comment submit")
+
+
 def post_comment_image(
     post_id,
     file_path,
@@ -296,269 +815,74 @@ def post_comment_image(
     evaluation,
     best_continuation,
     summary,
+    session: BrowserSession | None = None,
 ):
-    counts = {c: [0, 0] for c in HUMANIZED_ORDER}
-    has_message = [False, False]
-    for m in messages:
-        idx = 0 if m.side == "left" else 1
-        has_message[idx] = True
-        if m.classification in counts:
-            counts[m.classification][idx] += 1
-        elif m.classification is Classification.FORCED:
-            counts[Classification.GOOD][idx] += 1
+    counts, has_message = count_classifications(messages)
     if counts[Classification.MEGABLUNDER] == [0, 0]:
         del counts[Classification.MEGABLUNDER]
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)  # Headful mode
-        context = None
-
-        if Path(STORAGE_FILE).exists():
-            print("Loading existing session...")
-            context = browser.new_context(
-                viewport={"width": 1600, "height": 900}, storage_state=STORAGE_FILE
-            )
-        else:
-            assert False
-
-        page = context.new_page()
+    with nullcontext(session) if session else BrowserSession() as session:
+        page = session.page()
 
         page.goto(f"https://www.reddit.com/r/TextingTheory/comments/{post_id}/")
 
         comments_button = page.locator('button[name="comments-action-button"]')
-        comments_button.wait_for(state="visible", timeout=20000)
-        comments_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        comments_button.click()
-
-        formatting_button = page.locator('button:has(svg[icon-name="format-outline"])')
-        formatting_button.wait_for(state="visible", timeout=5000)
-        formatting_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        formatting_button.click()
-
-        bold_button = page.locator('button:has(svg[icon-name="bold-outline"])')
-        bold_button.wait_for(state="visible", timeout=5000)
-        bold_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        bold_button.click()
-
-        page.wait_for_timeout(100)
-
-        page.keyboard.type("✪ Game Review", delay=10)
-        page.keyboard.press("Enter")
-
-        page.wait_for_timeout(50)
+        click_when_ready(comments_button, timeout=20000)
 
-        bold_button = page.locator('button:has(svg[icon-name="bold-outline"])')
-        bold_button.wait_for(state="visible", timeout=5000)
-        bold_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        bold_button.click()
+        click_when_ready(toolbar_button(page, "format-outline"))
 
-        page.wait_for_timeout(100)
+        click_when_ready(toolbar_button(page, "bold-outline"))
+        write_line(page, "✪ Game Review")
+        click_when_ready(toolbar_button(page, "bold-outline"))
 
-        page.keyboard.type(summary, delay=10)
-        page.keyboard.press("Enter")
+        write_line(page, summary)
 
-        page.wait_for_timeout(50)
-
-        image_button = page.locator('button:has(svg[icon-name="image-post-outline"])')
-        image_button.wait_for(state="visible", timeout=5000)
-
-        with page.expect_file_chooser() as fc_info:
-            image_button.scroll_into_view_if_needed()
-            page.wait_for_timeout(100)
-            image_button.click()
-
-        page.wait_for_timeout(100)
-
-        file_chooser = fc_info.value
-        file_chooser.set_files(file_path)
-
-        page.wait_for_timeout(200)
+        attach_image(page, file_path)
 
         if evaluation is not None:
-            LOSS_RESULTS = [
-                Classification.CHECKMATED,
-                Classification.ABANDON,
-                Classification.RESIGN,
-                Classification.TIMEOUT,
-            ]
-            left_classifications, right_classifications = [
-                m.classification for m in messages if m.side == "left"
-            ], [m.classification for m in messages if m.side == "right"]
-            TOTAL_SQUARES = 16
-            if any(loss_result in left_classifications for loss_result in LOSS_RESULTS):
-                b_squares, w_squares = 0, TOTAL_SQUARES
-                eval_str = "1-0"
-                eval_str_right = True
-            elif any(
-                loss_result in right_classifications for loss_result in LOSS_RESULTS
-            ):
-                b_squares, w_squares = TOTAL_SQUARES, 0
-                eval_str = "0-1"
-                eval_str_right = False
-            elif (
-                Classification.DRAW in left_classifications
-                or Classification.DRAW in right_classifications
-            ):
-                b_squares, w_squares = TOTAL_SQUARES // 2, TOTAL_SQUARES // 2
-                eval_str = "½-½"
-                eval_str_right = True
-            elif evaluation[0] == "M":
-                b_squares, w_squares = 0, TOTAL_SQUARES
-                eval_str = evaluation
-                eval_str_right = True
-            elif evaluation[0] == "m":
-                b_squares, w_squares = TOTAL_SQUARES, 0
-                eval_str = evaluation.upper()
-                eval_str_right = False
-            else:
-                evaluation = float(evaluation)
-                eval_str_right = evaluation >= 0
-                evaluation = abs(evaluation)
-                eval_str = (
-                    f"{evaluation:.1f}" if evaluation < 10 else f"{evaluation:.0f}"
-                )
-
-                b_squares, w_squares = eval_to_emoji_squares(evaluation)
-                if not eval_str_right:
-                    b_squares, w_squares = w_squares, b_squares
-
-            eval_bar = BLACK_SQUARE * b_squares + WHITE_SQUARE * w_squares
-            if eval_str_right:
-                eval_bar = eval_bar + eval_str
-            else:
-                eval_bar = eval_str + eval_bar
-
-            page.keyboard.type(eval_bar, delay=10)
-
-            page.keyboard.press("Enter")
-
-            page.wait_for_timeout(50)
+            write_line(page, format_eval_bar(messages, evaluation))
 
         if best_continuation is not None:
-            if best_continuation != "Resign":
-                best_continuation = f'"{best_continuation}"'
-            if messages and messages[-1].unsent:
-                page.keyboard.type(
-                    f"Suggested alternative: {best_continuation}", delay=10
-                )
-            else:
-                page.keyboard.type(f"Best continuation: {best_continuation}", delay=10)
-            page.keyboard.press("Enter")
-
-            page.wait_for_timeout(50)
+            write_line(page, format_best_continuation(messages, best_continuation))
 
         page.keyboard.press("Control+I")
-
-        page.wait_for_timeout(50)
-
-        page.keyboard.type(f"{opening}", delay=10)
-        page.keyboard.press("Enter")
-
-        page.wait_for_timeout(50)
+        write_line(page, f"{opening}")
 
         # page.keyboard.press("Control+I")
+        # write_line(page, "New Elo scale: ~600 median, ~450 average")
 
-        # page.wait_for_timeout(50)
-
-        # page.keyboard.type(f"New Elo scale: ~600 median, ~450 average", delay=10)
-        # page.keyboard.press("Enter")
-
-        # page.wait_for_timeout(50)
-
-        table_button = page.locator('button:has(svg[icon-name="table-outline"])')
-        table_button.wait_for(state="visible", timeout=5000)
-        table_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(250)
-        table_button.click()
+        editor = page.locator(COMPOSER_EDITOR).last
+        table_rows = editor.locator("tr")
+        click_when_ready(toolbar_button(page, "table-outline"))
+        if wait_for_state(table_rows.first, "visible"):
+            rows = table_rows.count()
+        else:
+            rows = None
 
         for _ in range(len(counts) - 2):
             table_actions_button = page.locator(
                 'button:has(svg[icon-name="overflow-horizontal-outline"]) >> text=Table actions menu'
             )
-            table_actions_button.wait_for(state="visible", timeout=5000)
-            table_actions_button.scroll_into_view_if_needed()
-            page.wait_for_timeout(200)
-            table_actions_button.click()
-
-            insert_row_button = page.get_by_text("Insert row below", exact=True)
-            insert_row_button.wait_for(state="visible", timeout=5000)
-            insert_row_button.scroll_into_view_if_needed()
-            page.wait_for_timeout(200)
-            insert_row_button.click()
+            click_when_ready(table_actions_button)
+            click_when_ready(page.get_by_text("Insert row below", exact=True))
+            if rows is not None:
+                rows += 1
+                wait_for_count(table_rows, rows)
 
         # table_actions_button = page.locator('button:has(svg[icon-name="overflow-horizontal-outline"]) >> text=Table actions menu')
-        # table_actions_button.wait_for(state="visible", timeout=5000)
-        # table_actions_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # table_actions_button.click()
-
-        # align_center_button = page.get_by_text("Align center", exact=True)
-        # align_center_button.wait_for(state="visible", timeout=5000)
-        # align_center_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # align_center_button.click()
+        # click_when_ready(table_actions_button)
+        # click_when_ready(page.get_by_text("Align center", exact=True))
 
-        page.wait_for_timeout(200)
-
-        page.keyboard.type("a")
-        page.wait_for_timeout(200)
+        page.keyboard.press("a")
         page.keyboard.press("Backspace")
-        page.wait_for_timeout(100)
 
         if color_left is not None and has_message[0]:
-            page.keyboard.type(f"{color_left} ({elo_left})", delay=10)
+            page.keyboard.insert_text(f"{color_left} ({elo_left})")
         page.keyboard.press("Tab")
-        page.wait_for_timeout(50)
-
-        # table_actions_button = page.locator('button:has(svg[icon-name="overflow-horizontal-outline"]) >> text=Table actions menu')
-        # table_actions_button.wait_for(state="visible", timeout=5000)
-        # table_actions_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # table_actions_button.click()
-
-        # align_center_button = page.get_by_text("Align center", exact=True)
-        # align_center_button.wait_for(state="visible", timeout=5000)
-        # align_center_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # align_center_button.click()
-
-        # page.wait_for_timeout(200)
-
-        # page.keyboard.type("a")
-        # page.wait_for_timeout(200)
-        # page.keyboard.press("Backspace")
-        # page.wait_for_timeout(100)
-
         page.keyboard.press("Tab")
-        page.wait_for_timeout(50)
-
-        # table_actions_button = page.locator('button:has(svg[icon-name="overflow-horizontal-outline"]) >> text=Table actions menu')
-        # table_actions_button.wait_for(state="visible", timeout=5000)
-        # table_actions_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # table_actions_button.click()
-
-        # align_center_button = page.get_by_text("Align center", exact=True)
-        # align_center_button.wait_for(state="visible", timeout=5000)
-        # align_center_button.scroll_into_view_if_needed()
-        # page.wait_for_timeout(200)
-        # align_center_button.click()
-
-        # page.wait_for_timeout(200)
-
-        # page.keyboard.type("a")
-        # page.wait_for_timeout(200)
-        # page.keyboard.press("Backspace")
-        # page.wait_for_timeout(100)
-
         if color_right is not None and has_message[1]:
-            page.keyboard.type(f"{color_right} ({elo_right})", delay=10)
+            page.keyboard.insert_text(f"{color_right} ({elo_right})")
         page.keyboard.press("Tab")
-        page.wait_for_timeout(50)
 
         for c in HUMANIZED_ORDER:
             if c not in counts:
@@ -567,278 +891,344 @@ def post_comment_image(
             label = c.name.replace("_", " ").title()
 
             if color_left is not None and has_message[0]:
-                page.keyboard.type(str(l), delay=10)
+                page.keyboard.insert_text(str(l))
             page.keyboard.press("Tab")
-            page.wait_for_timeout(50)
-            page.keyboard.type(label, delay=10)
+            page.keyboard.insert_text(label)
             page.keyboard.press("Tab")
-            page.wait_for_timeout(50)
             if color_right is not None and has_message[1]:
-                page.keyboard.type(str(r), delay=10)
+                page.keyboard.insert_text(str(r))
             page.keyboard.press("Tab")
-            page.wait_for_timeout(50)
 
         page.keyboard.press("Enter")
-        # page.keyboard.press("Enter")
 
         if Classification.MEGABLUNDER in counts:
-            page.keyboard.type("Megablunder Monday!", delay=5)
-            page.wait_for_timeout(50)
-            page.keyboard.press("Enter")
+            write_line(page, "Megablunder Monday!")
 
         if similar_conversations:
-            page.keyboard.type("Similar Games:", delay=5)
-            page.wait_for_timeout(50)
-            page.keyboard.press("Enter")
+            write_line(page, "Similar Games:")
             for i, (post_id, score, _) in enumerate(similar_conversations, start=1):
-                page.keyboard.type(f"{i}. ", delay=5)
-
-                link_button = page.locator('button:has(svg[icon-name="link-outline"])')
-                link_button.wait_for(state="visible", timeout=5000)
-                link_button.scroll_into_view_if_needed()
-                page.wait_for_timeout(100)
-                link_button.click()
-
-                page.wait_for_timeout(100)
-
-                page.keyboard.press("Tab")
-                page.wait_for_timeout(100)
-                page.keyboard.type(f"{get_post_by_id(post_id).title}", delay=5)
-                page.wait_for_timeout(100)
-                page.keyboard.press("Tab")
-                page.wait_for_timeout(100)
-                page.keyboard.type(
+                page.keyboard.insert_text(f"{i}. ")
+                insert_link(
+                    page,
+                    post_title(post_id),
                     f"https://www.reddit.com/r/TextingTheory/comments/{post_id}/",
-                    delay=5,
                 )
+                write_line(page, f" ({score:.1%})")
 
-                save_link_button = page.get_by_test_id("btn-save-link")
-                save_link_button.wait_for(state="visible", timeout=5000)
-                save_link_button.scroll_into_view_if_needed()
-                page.wait_for_timeout(100)
-                save_link_button.click()
+        # https://support.chess.com/en/articles/8584089-how-does-game-review-work#h_49f5656333 https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqefbfm/
+        for i, (text, url) in enumerate(ABOUT_LINKS):
+            if i:
+                page.keyboard.insert_text(" | ")
+            insert_link(page, text, url)
 
-                page.wait_for_timeout(50)
+        page.keyboard.press("Shift+Home")
+        click_when_ready(toolbar_button(page, "superscript-outline"))
 
-                page.keyboard.type(f" ({score:.1%})", delay=5)
+        submit_comment(page, timeout=10000)
 
-                page.wait_for_timeout(50)
+        print("Analysis Posted")
 
-                page.keyboard.press("Enter")
 
-        # page.keyboard.press("Enter")
+def post_comment_reply_image(
+    post_id, comment_id, file_path, session: BrowserSession | None = None
+):
+    with nullcontext(session) if session else BrowserSession() as session:
+        page = session.page()
+        page.goto(
+            f"https://www.reddit.com/r/TextingTheory/comments/{post_id}/comment/{comment_id}/"
+        )
 
-        link_button = page.locator('button:has(svg[icon-name="link-outline"])')
-        link_button.wait_for(state="visible", timeout=5000)
-        link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        link_button.click()
+        reply_button = page.locator(
+            "button.button-plain-weak:has(svg[icon-name='comment-outline']):has-text('Reply')"
+        ).nth(0)
+        click_when_ready(reply_button)
 
-        page.wait_for_timeout(100)
+        attach_image(page, file_path)
 
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        page.keyboard.type("about the bot", delay=5)
-        page.wait_for_timeout(100)
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        # page.keyboard.type("https://support.chess.com/en/articles/8584089-how-does-game-review-work#h_49f5656333", delay=5) https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqefbfm/
-        page.keyboard.type(
-            "https://www.reddit.com/r/TextingTheory/comments/1k8fed9/utextingtheorybot/",
-            delay=5,
-        )
+        submit_comment(page)
 
-        save_link_button = page.get_by_test_id("btn-save-link")
-        save_link_button.wait_for(state="visible", timeout=5000)
-        save_link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        save_link_button.click()
+        print(f"comment replied: {comment_id}")
 
-        page.wait_for_timeout(50)
 
-        page.keyboard.type(" | ", delay=5)
+def reply_to_comment(comment_id: str, message: str):
+    try:
+        comment = reddit_client().comment(id=comment_id)
+        comment.reply(message)
+        print(f"Replied to comment {comment_id}")
+    except Exception as e:
+        print(f"[!] Failed to reply to comment {comment_id}: {e}")
 
-        page.wait_for_timeout(50)
 
-        link_button = page.locator('button:has(svg[icon-name="link-outline"])')
-        link_button.wait_for(state="visible", timeout=5000)
-        link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        link_button.click()
+POST_BACKEND = os.getenv("POST_BACKEND") or "playwright"
 
-        page.wait_for_timeout(100)
+REDDIT_MEDIA_LEASE = "api/media/asset.json"
 
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        page.keyboard.type("what do the symbols mean?", delay=5)
-        page.wait_for_timeout(100)
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        page.keyboard.type(
-            "https://www.reddit.com/r/TextingTheory/comments/1ksad21/classifications_badges_explained/",
-            delay=5,
-        )
+RTJSON_BOLD = 1
+RTJSON_ITALIC = 2
+RTJSON_SUPERSCRIPT = 32
 
-        save_link_button = page.get_by_test_id("btn-save-link")
-        save_link_button.wait_for(state="visible", timeout=5000)
-        save_link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        save_link_button.click()
 
-        page.wait_for_timeout(50)
+def rt_text(text, fmt=0):
+    span = {"e": "text", "t": text}
+    if fmt:
+        span["f"] = [[fmt, 0, len(text)]]
+    return span
 
-        page.keyboard.type(" | ", delay=5)
 
-        page.wait_for_timeout(50)
+def rt_link(text, url, fmt=0):
+    return {**rt_text(text, fmt), "e": "link", "u": url}
 
-        link_button = page.locator('button:has(svg[icon-name="link-outline"])')
-        link_button.wait_for(state="visible", timeout=5000)
-        link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        link_button.click()
 
-        page.wait_for_timeout(100)
+def rt_par(*spans):
+    return {"e": "par", "c": [span for span in spans if span["t"]]}
 
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        page.keyboard.type("!annotate", delay=5)
-        page.wait_for_timeout(100)
-        page.keyboard.press("Tab")
-        page.wait_for_timeout(100)
-        page.keyboard.type(
-            "https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/",
-            delay=5,
+
+def rt_table(header, rows):
+    def cell(text):
+        return {"c": [rt_text(text)] if text else []}
+
+    return {
+        "e": "table",
+        "h": [cell(text) for text in header],
+        "c": [[cell(text) for text in row] for row in rows],
+    }
+
+
+def build_analysis_richtext(
+    media_id,
+    messages,
+    color_left,
+    color_right,
+    elo_left,
+    elo_right,
+    opening,
+    similar_conversations,
+    evaluation,
+    best_continuation,
+    summary,
+):
+    # Same layout post_comment_image types into the web composer, as RTJSON.
+    counts, has_message = count_classifications(messages)
+    if counts[Classification.MEGABLUNDER] == [0, 0]:
+        del counts[Classification.MEGABLUNDER]
+    show_left = color_left is not None and has_message[0]
+    show_right = color_right is not None and has_message[1]
+
+    document = [rt_par(rt_text("✪ Game Review", RTJSON_BOLD))]
+    document += [rt_par(rt_text(line)) for line in summary.split("\n")]
+    document.append({"e": "img", "id": media_id})
+    if evaluation is not None:
+        document.append(rt_par(rt_text(format_eval_bar(messages, evaluation))))
+    if best_continuation is not None:
+        document.append(
+            rt_par(rt_text(format_best_continuation(messages, best_continuation)))
         )
+    document.append(rt_par(rt_text(f"{opening}", RTJSON_ITALIC)))
 
-        save_link_button = page.get_by_test_id("btn-save-link")
-        save_link_button.wait_for(state="visible", timeout=5000)
-        save_link_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        save_link_button.click()
+    header = [
+        f"{color_left} ({elo_left})" if show_left else "",
+        "",
+        f"{color_right} ({elo_right})" if show_right else "",
+    ]
+    rows = [
+        [
+            str(l) if show_left else "",
+            c.name.replace("_", " ").title(),
+            str(r) if show_right else "",
+        ]
+        for c, (l, r) in counts.items()
+    ]
+    document.append(rt_table(header, rows))
+
+    if Classification.MEGABLUNDER in counts:
+        document.append(rt_par(rt_text("Megablunder Monday!")))
+
+    if similar_conversations:
+        document.append(rt_par(rt_text("Similar Games:")))
+        for i, (post_id, score, _) in enumerate(similar_conversations, start=1):
+            document.append(
+                rt_par(
+                    rt_text(f"{i}. "),
+                    rt_link(
+                        post_title(post_id),
+                        f"https://www.reddit.com/r/TextingTheory/comments/{post_id}/",
+                    ),
+                    rt_text(f" ({score:.1%})"),
+                )
+            )
 
-        page.wait_for_timeout(100)
+    footer = []
+    for i, (text, url) in enumerate(ABOUT_LINKS):
+        if i:
+            footer.append(rt_text(" | ", RTJSON_SUPERSCRIPT))
+        footer.append(rt_link(text, url, RTJSON_SUPERSCRIPT))
+    document.append(rt_par(*footer))
 
-        page.keyboard.press("Shift+Home")
+    return {"document": document}
 
-        table_button = page.locator('button:has(svg[icon-name="superscript-outline"])')
-        table_button.wait_for(state="visible", timeout=5000)
-        table_button.scroll_into_view_if_needed()
-        page.wait_for_timeout(250)
-        table_button.click()
 
-        comment_submit = page.locator('button[slot="submit-button"][type="submit"]')
-        comment_submit.wait_for(state="visible", timeout=10000)
-        comment_submit.scroll_into_view_if_needed()
-        page.wait_for_timeout(100)
-        comment_submit.click()
+def upload_reddit_media(file_path):
+    name = os.path.basename(file_path)
+    mimetype = mimetypes.guess_type(name)[0] or "image/png"
+    lease = reddit_client().post(
+        REDDIT_MEDIA_LEASE, data={"filepath": name, "mimetype": mimetype}
+    )
+    upload = lease["args"]
+    fields = {field["name"]: field["value"] for field in upload["fields"]}
+    with open(file_path, "rb") as f:
+        r = http.post(
+            urljoin("https:", upload["action"]),
+            data=fields,
+            files={"file": (name, f, mimetype)},
+            timeout=IMAGE_DOWNLOAD_TIMEOUT,
+        )
+    r.raise_for_status()
+    return lease["asset"]["asset_id"]
+
+
+def submit_richtext_comment(thing_id, document):
+    return reddit_client().post(
+        "api/comment",
+        data={
+            "thing_id": thing_id,
+            "richtext_json": json.dumps(document),
+            "api_type": "json",
+        },
+    )
 
-        print("Analysis Posted")
 
-        page.wait_for_timeout(4000)
+class CommentBackend(ABC):
+    # How image comments reach Reddit. post_analysis takes the same arguments
+    # as post_comment_image (without the session).
+    def __enter__(self):
+        return self
 
-        # Clean up
-        browser.close()
+    def __exit__(self, *exc_info):
+        self.close()
 
+    @abstractmethod
+    def post_analysis(self, post_id, file_path, messages, *details):
+        pass
 
-def post_comment_replies(render_queue):
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=False)  # Headful mode
-        context = None
+    @abstractmethod
+    def post_image_reply(self, post_id, comment_id, file_path):
+        pass
 
-        if Path(STORAGE_FILE).exists():
-            print("Loading existing session...")
-            context = browser.new_context(
-                viewport={"width": 1600, "height": 900}, storage_state=STORAGE_FILE
-            )
-        else:
-            assert False
+    def reset(self):
+        pass
 
-        page = context.new_page()
-        for post_id, comment_id, out_path in render_queue:
-            try:
-                page.goto(
-                    f"https://www.reddit.com/r/TextingTheory/comments/{post_id}/comment/{comment_id}/"
-                )
+    def close(self):
+        pass
 
-                reply_button = page.locator(
-                    "button.button-plain-weak:has(svg[icon-name='comment-outline']):has-text('Reply')"
-                ).nth(0)
-                reply_button.wait_for(state="visible", timeout=5000)
-                reply_button.scroll_into_view_if_needed()
-                page.wait_for_timeout(100)
-                reply_button.click()
 
-                image_button = page.locator(
-                    'button:has(svg[icon-name="image-post-outline"])'
-                )
-                image_button.wait_for(state="visible", timeout=5000)
+class PlaywrightBackend(CommentBackend):
+    def __init__(self, session: BrowserSession | None = None):
+        self.session = session or BrowserSession()
 
-                with page.expect_file_chooser() as fc_info:
-                    image_button.scroll_into_view_if_needed()
-                    page.wait_for_timeout(100)
-                    image_button.click()
+    def post_analysis(self, post_id, file_path, messages, *details):
+        post_comment_image(post_id, file_path, messages, *details, session=self.session)
 
-                page.wait_for_timeout(100)
+    def post_image_reply(self, post_id, comment_id, file_path):
+        post_comment_reply_image(post_id, comment_id, file_path, session=self.session)
 
-                file_chooser = fc_info.value
-                file_chooser.set_files(out_path)
+    def reset(self):
+        self.session.discard_page()
 
-                page.wait_for_timeout(200)
+    def close(self):
+        self.session.close()
 
-                comment_submit = page.locator(
-                    'button[slot="submit-button"][type="submit"]'
-                )
-                comment_submit.wait_for(state="visible", timeout=5000)
-                comment_submit.scroll_into_view_if_needed()
-                page.wait_for_timeout(100)
-                comment_submit.click()
 
-                print(f"comment replied: {comment_id}")
+class ApiBackend(CommentBackend):
+    # Uploads the image through Reddit's media lease and submits the comment
+    # as rich text. If the upload itself fails nothing has been posted yet, so
+    # the comment goes through the fallback backend instead.
+    def __init__(self, fallback: CommentBackend | None = None):
+        self.fallback = fallback
 
-                page.wait_for_timeout(2000)
+    def _upload(self, file_path):
+        try:
+            return upload_reddit_media(file_path)
+        except Exception as e:
+            if self.fallback is None:
+                raise
+            print(f"[!] Media upload failed, posting through fallback: {e}")
+            return None
+
+    def post_analysis(self, post_id, file_path, messages, *details):
+        media_id = self._upload(file_path)
+        if media_id is None:
+            return self.fallback.post_analysis(post_id, file_path, messages, *details)
+        submit_richtext_comment(
+            f"t3_{post_id}", build_analysis_richtext(media_id, messages, *details)
+        )
+        print("Analysis Posted")
+
+    def post_image_reply(self, post_id, comment_id, file_path):
+        media_id = self._upload(file_path)
+        if media_id is None:
+            return self.fallback.post_image_reply(post_id, comment_id, file_path)
+        submit_richtext_comment(
+            f"t1_{comment_id}", {"document": [{"e": "img", "id": media_id}]}
+        )
+        print(f"comment replied: {comment_id}")
+
+    def reset(self):
+        if self.fallback is not None:
+            self.fallback.reset()
+
+    def close(self):
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+def comment_backend(name=POST_BACKEND):
+    if name == "playwright":
+        return PlaywrightBackend()
+    if name == "api":
+        return ApiBackend(fallback=PlaywrightBackend())
+    raise ValueError(f"Unknown POST_BACKEND: {name}")
+
+
+def post_comment_replies(render_queue, backend: CommentBackend | None = None):
+    with nullcontext(backend) if backend else comment_backend() as backend:
+        for post_id, comment_id, out_path in render_queue:
+            try:
+                backend.post_image_reply(post_id, comment_id, out_path)
             except Exception as e:
                 print(f"[!] Failed to post comment reply for {comment_id}: {e}")
+                backend.reset()
                 continue
 
-        # Clean up
-        browser.close()
-
 
-def reply_to_comment(comment_id: str, message: str):
-    try:
-        comment = reddit.comment(id=comment_id)
-        comment.reply(message)
-        print(f"Replied to comment {comment_id}")
-    except Exception as e:
-        print(f"[!] Failed to reply to comment {comment_id}: {e}")
+ANNOTATE_HELP_LINK = "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)"
 
 
-def old_handle_top_level(
-    cid: str, pid: str, code: str, tmpdir: str, render_queue: list
-):
+def load_top_level_target(pid: str):
+    # The checks that only depend on the post, done once per post however
+    # many annotations it gets. Returns (post_data, msgs, error reply).
 
     # 1) fetch analysis JSON
     post_data = get_post_json_from_kv(pid)
     if not post_data:
-        reply_to_comment(
-            cid,
+        return (
+            None,
+            None,
             "⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
             "- No analysis found for current post.\n\n"
             "Please try again after the bot has left an analysis.\n\n"
-            "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)",
+            f"{ANNOTATE_HELP_LINK}",
         )
-        return
 
     # 2) re-parse the LLM messages
     msgs = parse_llm_response(post_data, ignore_classifications=True)
     if len(msgs) > 20:
-        reply_to_comment(
-            cid,
+        return (
+            None,
+            None,
             f"⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
             f"- This post has **{len(msgs)} messages**, which exceeds the 20-message limit.\n\n"
-            "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)",
+            f"{ANNOTATE_HELP_LINK}",
         )
-        return
 
     # 3) age check
     post = get_post_by_id(pid)
@@ -846,34 +1236,34 @@ def old_handle_top_level(
         post.created_utc, tz=timezone.utc
     )
     if age > timedelta(days=7):
-        reply_to_comment(
-            cid,
+        return (
+            None,
+            None,
             "⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
             "- This post is **over 7 days old**.\n\n"
-            "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)",
+            f"{ANNOTATE_HELP_LINK}",
         )
-        return
 
+    return post_data, msgs, None
+
+
+def render_top_level_annotation(pid, post_data, msgs, code, out_path):
     # 4) apply the user’s code
     updated_msgs, err = apply_annotation_code(msgs, code)
     if updated_msgs is None:
         if err == "len":
-            err_msg = (
+            return (
                 f"⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
                 f"- The annotation code doesn't match the number of messages ({len(msgs)}).\n\n"
-                "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)"
-            )
-        else:
-            err_msg = (
-                f"⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
-                "- The annotation code contains an unexpected character.\n\n"
-                "[about !annotate](https://www.reddit.com/r/TextingTheory/comments/1kdxh6x/comment/mqk2jzn/)"
+                f"{ANNOTATE_HELP_LINK}"
             )
-        reply_to_comment(cid, err_msg)
-        return
+        return (
+            f"⚠️ Sorry, your `!annotate` request couldn't be processed:\n\n"
+            "- The annotation code contains an unexpected character.\n\n"
+            f"{ANNOTATE_HELP_LINK}"
+        )
 
-    # 5) render into tmpdir and queue
-    out_path = os.path.join(tmpdir, f"{cid}_annotated.png")
+    # 5) render into tmpdir
     color_left = post_data["color"].get("left")
     color_right = post_data["color"].get("right")
     background = post_data["color"].get("background_hex")
@@ -884,8 +1274,34 @@ def old_handle_top_level(
         color_data_right=color_right,
         background_hex=background,
         output_path=out_path,
+        cache_key=pid,
     )
-    render_queue.append((pid, cid, out_path))
+    return None
+
+
+def handle_top_level_group(pid: str, commands: list, tmpdir: str, render_queue: list):
+    try:
+        post_data, msgs, err_msg = load_top_level_target(pid)
+    except Exception as e:
+        print(f"⚠️ Could not load post {pid} for {len(commands)} annotations: {e}")
+        return
+    if err_msg:
+        for cid, _ in commands:
+            reply_to_comment(cid, err_msg)
+        return
+
+    # identical codes on the same post render to the same image
+    rendered = {}
+    for cid, code in commands:
+        if code not in rendered:
+            out_path = os.path.join(tmpdir, f"{cid}_annotated.png")
+            err_msg = render_top_level_annotation(pid, post_data, msgs, code, out_path)
+            rendered[code] = (out_path, err_msg)
+        out_path, err_msg = rendered[code]
+        if err_msg:
+            reply_to_comment(cid, err_msg)
+            continue
+        render_queue.append((pid, cid, out_path))
 
 
 import re
@@ -900,6 +1316,16 @@ def extract_display_text(md_text):
 
 def handle_annotate(comments_json):
     render_queue = []
+    top_level = {}  # post id -> [(comment id, code)]
+    chains = {}  # (parent id, depth) -> parent comments, oldest last
+    rendered_chains = {}  # (parent id, code) -> rendered image
+
+    # top-level annotations read their post's analysis; fetch each one once
+    kv_client().get_many(
+        f"post:{cmd['post_id']}"
+        for cmd in comments_json
+        if cmd["parent_id"].startswith("t3_")
+    )
 
     # We open one tempdir for this whole run, so files live until after we reply:
     with tempfile.TemporaryDirectory() as tmpdir:
@@ -925,11 +1351,14 @@ def handle_annotate(comments_json):
                 )
                 continue
 
-            # top‐level case: fall back to your existing flow
+            # top‐level case: grouped by post and handled after the loop
             if p_id.startswith("t3_"):
-                # … just call your old top‐level logic here, e.g.
-                old_handle_top_level(cid, pid, code, tmpdir, render_queue)
-                # and continue
+                top_level.setdefault(pid, []).append((cid, code))
+                continue
+
+            # same parent and same code render the same chain
+            if (p_id, code) in rendered_chains:
+                render_queue.append((pid, cid, rendered_chains[(p_id, code)]))
                 continue
 
             # if "-" in code:
@@ -941,19 +1370,22 @@ def handle_annotate(comments_json):
             #     continue
 
             # otherwise, walk up the reply chain
-            chain = []
-            try:
-                cur = reddit.comment(id=cid)
-                while len(chain) < depth:
-                    parent = cur.parent()
-                    if isinstance(parent, praw.models.Comment):
-                        chain.append(parent)
-                        cur = parent
-                    else:
-                        break
-            except Exception as e:
-                print(cid, f"⚠️ Could not fetch comment chain: {e}")
-                continue
+            if (p_id, depth) not in chains:
+                chain = []
+                try:
+                    cur = reddit_client().comment(id=cid)
+                    while len(chain) < depth:
+                        parent = cur.parent()
+                        if isinstance(parent, praw.models.Comment):
+                            chain.append(parent)
+                            cur = parent
+                        else:
+                            break
+                except Exception as e:
+                    print(cid, f"⚠️ Could not fetch comment chain: {e}")
+                    continue
+                chains[(p_id, depth)] = chain
+            chain = chains[(p_id, depth)]
 
             if len(chain) < depth:
                 reply_to_comment(
@@ -998,11 +1430,16 @@ def handle_annotate(comments_json):
             # render into tmpdir
             out_path = f"{tmpdir}/{cid}_annotated.png"
             render_reddit_chain(updated, out_path)
+            rendered_chains[(p_id, code)] = out_path
             render_queue.append((pid, cid, out_path))
 
+        for pid, commands in top_level.items():
+            handle_top_level_group(pid, commands, tmpdir, render_queue)
+
         # now that all files still exist, post your replies
         if render_queue:
-            post_comment_replies(render_queue)
+            with comment_backend() as backend:
+                post_comment_replies(render_queue, backend)
 
     print("All annotate commands handled.")
 
@@ -1036,131 +1473,611 @@ def extract_image_urls(post):
     return image_urls
 
 
-def handle_new_posts(post_id=None):
-    # for post in get_recent_posts():
-    # for post in get_top_posts():
-    if post_id is None:
-        posts = get_recent_posts()
-    else:
-        posts = [get_post_by_id(post_id)]
-    for post in posts:
-        print(f"Looking at post {post.id}")
-        # if post.id != "1k40vss":
-        #     continue
-
-        if any(
-            c.author and c.author.name.lower() == reddit.user.me().name.lower()
-            for c in post.comments
-        ):
-            print("Already analyzed")
-            continue
+DOWNLOAD_WORKERS = 8
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+IMAGE_DOWNLOAD_TIMEOUT = 30  # seconds for a whole image, not per read
+IMAGE_CHUNK_SIZE = 64 * 1024
 
-        image_urls = extract_image_urls(post)
+http = requests.Session()
+http.headers["User-Agent"] = "Mozilla"
+_http_adapter = HTTPAdapter(
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+    ),
+)
+http.mount("https://", _http_adapter)
+http.mount("http://", _http_adapter)
 
-        if not image_urls:
-            print("No images found")
-            continue
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            input_paths = []
-            for idx, url in enumerate(image_urls):
-                path = os.path.join(tmpdir, f"img{idx}.jpg")
-                r = requests.get(url, headers={"User-Agent": "Mozilla"})
-                with open(path, "wb") as f:
-                    f.write(r.content)
-                input_paths.append(path)
-
-            # stitched = os.path.join(tmpdir, "stitched.jpg")
-            out_path = os.path.join(tmpdir, "out.jpg")
-            # stitch_images_vertically(input_paths, stitched)
-            print(f"Analyzing post with title: {post.title}")
-            for attempt in range(2):
-                try:
-                    data = call_llm_on_image(input_paths, post.title, post.selftext)
-                    break
-                except Exception as e:
-                    print(
-                        f"Call llm attempt {attempt + 1} failed due to unexpected error: {e}"
-                    )
-                    time.sleep(15)
+def download_image(url, path):
+    deadline = time.monotonic() + IMAGE_DOWNLOAD_TIMEOUT
+    with http.get(url, stream=True, timeout=(5, 10)) as r:
+        r.raise_for_status()
+        if int(r.headers.get("Content-Length") or 0) > MAX_IMAGE_BYTES:
+            raise ValueError(f"Image too large: {url}")
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise ValueError(f"Image too large: {url}")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Image download timed out: {url}")
+                f.write(chunk)
+    return path
+
+
+def download_images(image_urls, dest_dir):
+    paths = [os.path.join(dest_dir, f"img{idx}.jpg") for idx in range(len(image_urls))]
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(DOWNLOAD_WORKERS, len(image_urls)))
+    ) as pool:
+        return list(pool.map(download_image, image_urls, paths))
+
+
+ANALYZE_WORKERS = int(os.environ.get("ANALYZE_WORKERS", "4"))
+
+STATE_DB_FILE = os.path.join(CACHE_DIR, "state.sqlite3")
+STATE_DB_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS processed_posts (
+        post_id TEXT PRIMARY KEY,
+        outcome TEXT NOT NULL,
+        content_hash TEXT,
+        updated_at REAL NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS embeddings (
+        key TEXT PRIMARY KEY,
+        vector BLOB NOT NULL,
+        used_at REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)",
+    """CREATE TABLE IF NOT EXISTS post_images (
+        post_id TEXT PRIMARY KEY,
+        digest TEXT NOT NULL,
+        images INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS post_images_digest ON post_images (digest)",
+    # one row per (image, dhash band) so near duplicates are an index lookup
+    """CREATE TABLE IF NOT EXISTS image_hashes (
+        post_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        dhash INTEGER NOT NULL,
+        band INTEGER NOT NULL,
+        band_value INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS image_hashes_band ON image_hashes (band, band_value)",
+    "CREATE INDEX IF NOT EXISTS image_hashes_post ON image_hashes (post_id)",
+    # 16x16 dhash of each image, to confirm a near match found through the bands
+    """CREATE TABLE IF NOT EXISTS image_fine_hashes (
+        post_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        dhash BLOB NOT NULL,
+        PRIMARY KEY (post_id, position)
+    )""",
+]
 
-            if data.get("is_convo") is False:
-                print("Not a conversation, skipping")
-            else:
-                elo_left, elo_right = data["elo"].get("left"), data["elo"].get("right")
-                color_data_left, color_data_right = data["color"].get("left"), data[
-                    "color"
-                ].get("right")
-                msgs = parse_llm_response(data)
-                print("Parsed LLM response")
-                render_conversation(
-                    msgs,
-                    color_data_left,
-                    color_data_right,
-                    data["color"]["background_hex"],
-                    out_path,
+# outcomes that end a post's life in the sweep; the rest get retried
+FINAL_OUTCOMES = {"posted", "already_analyzed"}
+# final only while the post still has the content that produced them
+CONTENT_OUTCOMES = {"not_convo", "no_images"}
+
+_state_db_lock = threading.Lock()
+
+
+@singleton
+def state_db():
+    os.makedirs(os.path.dirname(STATE_DB_FILE) or ".", exist_ok=True)
+    conn = sqlite3.connect(STATE_DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    for statement in STATE_DB_SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def post_content_hash(post):
+    content = json.dumps(
+        [post.title, post.selftext, extract_image_urls(post)], ensure_ascii=False
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def ledger_entry(post_id):
+    with _state_db_lock:
+        cursor = state_db().execute(
+            "SELECT outcome, content_hash FROM processed_posts WHERE post_id = ?",
+            (post_id,),
+        )
+        return cursor.fetchone()
+
+
+def record_outcome(post_id, outcome, content_hash=None):
+    with _state_db_lock:
+        state_db().execute(
+            """INSERT INTO processed_posts (post_id, outcome, content_hash, updated_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(post_id) DO UPDATE SET
+                outcome = excluded.outcome,
+                content_hash = COALESCE(excluded.content_hash, content_hash),
+                updated_at = excluded.updated_at""",
+            (post_id, outcome, content_hash, time.time()),
+        )
+
+
+def already_processed(post, content_hash):
+    entry = ledger_entry(post.id)
+    if entry is None:
+        return False
+    outcome, recorded_hash = entry
+    return outcome in FINAL_OUTCOMES or (
+        outcome in CONTENT_OUTCOMES and recorded_hash == content_hash
+    )
+
+
+# A 64-bit dhash only finds candidates: distinct screenshots of the same size
+# can be 5-7 bits apart. A candidate counts as a repost once every image is
+# also within FINE_DHASH_MAX_DISTANCE of 256 bits on the 16x16 dhash, where
+# recompressed and downscaled copies stay within 16 and distinct screenshots
+# are 60+ apart.
+DHASH_MAX_DISTANCE = 6
+DHASH_BANDS = 8  # 8-bit bands: any pair within 7 bits shares at least one
+FINE_DHASH_SIZE = 16
+FINE_DHASH_MAX_DISTANCE = 20
+
+
+def difference_hash(gray, size):
+    pixels = gray.resize((size + 1, size), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def image_fingerprint(path):
+    # (sha256 of the bytes, 8x8 dhash, 16x16 dhash)
+    with open(path, "rb") as f:
+        content = f.read()
+    with Image.open(path) as img:
+        img.draft("L", (64, 64))
+        gray = img.convert("L")
+    return (
+        hashlib.sha256(content).hexdigest(),
+        difference_hash(gray, 8),
+        difference_hash(gray, FINE_DHASH_SIZE),
+    )
+
+
+def _dhash_bands(dhash):
+    width = 64 // DHASH_BANDS
+    return [
+        (band, (dhash >> (band * width)) & ((1 << width) - 1))
+        for band in range(DHASH_BANDS)
+    ]
+
+
+def _to_sqlite_int(dhash):
+    # SQLite integers are signed 64-bit
+    return dhash - (1 << 64) if dhash >= 1 << 63 else dhash
+
+
+def _fine_dhash_bytes(dhash):
+    return dhash.to_bytes(FINE_DHASH_SIZE * FINE_DHASH_SIZE // 8, "big")
+
+
+def images_digest(fingerprints):
+    return hashlib.sha256(
+        "".join(sha for sha, _, _ in fingerprints).encode("ascii")
+    ).hexdigest()
+
+
+def record_image_fingerprints(post_id, fingerprints):
+    with _state_db_lock:
+        db = state_db()
+        db.execute("BEGIN")
+        try:
+            db.execute("DELETE FROM post_images WHERE post_id = ?", (post_id,))
+            db.execute("DELETE FROM image_hashes WHERE post_id = ?", (post_id,))
+            db.execute("DELETE FROM image_fine_hashes WHERE post_id = ?", (post_id,))
+            db.execute(
+                "INSERT INTO post_images (post_id, digest, images) VALUES (?, ?, ?)",
+                (post_id, images_digest(fingerprints), len(fingerprints)),
+            )
+            for position, (sha, coarse, fine) in enumerate(fingerprints):
+                db.executemany(
+                    """INSERT INTO image_hashes
+                    (post_id, position, sha256, dhash, band, band_value)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    [
+                        (post_id, position, sha, _to_sqlite_int(coarse), band, value)
+                        for band, value in _dhash_bands(coarse)
+                    ],
                 )
-                print("Rendered analysis image")
+                db.execute(
+                    "INSERT INTO image_fine_hashes (post_id, position, dhash)"
+                    " VALUES (?, ?, ?)",
+                    (post_id, position, _fine_dhash_bytes(fine)),
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+
+def find_repost(post_id, fingerprints):
+    # Exact match on the bytes of every image first. Otherwise a post whose
+    # images are each within DHASH_MAX_DISTANCE bits of ours, in the same
+    # order, and then also within FINE_DHASH_MAX_DISTANCE on the fine hash.
+    with _state_db_lock:
+        db = state_db()
+        row = db.execute(
+            "SELECT post_id FROM post_images WHERE digest = ? AND post_id != ? LIMIT 1",
+            (images_digest(fingerprints), post_id),
+        ).fetchone()
+        if row:
+            return row[0]
+
+        candidates = None
+        for position, (_, coarse, _) in enumerate(fingerprints):
+            bands = _dhash_bands(coarse)
+            rows = db.execute(
+                f"""SELECT DISTINCT h.post_id, h.dhash FROM image_hashes h
+                JOIN post_images p ON p.post_id = h.post_id
+                WHERE h.position = ? AND h.post_id != ? AND p.images = ?
+                AND ({" OR ".join(["(h.band = ? AND h.band_value = ?)"] * len(bands))})""",
+                [position, post_id, len(fingerprints)]
+                + [v for band in bands for v in band],
+            ).fetchall()
+            matched = {
+                other
+                for other, other_dhash in rows
+                if ((other_dhash % (1 << 64)) ^ coarse).bit_count()
+                <= DHASH_MAX_DISTANCE
+            }
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                return None
+
+        distances = {}
+        for other in candidates:
+            fine_hashes = dict(
+                db.execute(
+                    "SELECT position, dhash FROM image_fine_hashes WHERE post_id = ?",
+                    (other,),
+                ).fetchall()
+            )
+            if len(fine_hashes) != len(fingerprints):
+                continue  # recorded before fine hashes were kept
+            per_image = [
+                (int.from_bytes(fine_hashes[position], "big") ^ fine).bit_count()
+                for position, (_, _, fine) in enumerate(fingerprints)
+            ]
+            if max(per_image) <= FINE_DHASH_MAX_DISTANCE:
+                distances[other] = sum(per_image)
+    return min(distances, key=distances.get, default=None)
+
+
+@dataclass
+class PostAnalysis:
+    post: praw.models.Submission
+    data: dict
+    msgs: list[TextMessage]
+    out_path: str
+    convo_text: str
+    embedding: list[float] | None = None
+    similar_conversations: list = field(default_factory=list)
+
+
+@singleton
+def bot_username():
+    return reddit_client().user.me().name.lower()
+
+
+class BotCommentIndex:
+    # Posts the bot has commented on, built from one listing of its recent
+    # comments rather than loading every post's comment forest.
+    def __init__(self, limit=100):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._post_ids = None
+        self._oldest = None
+        self._complete = False
+
+    def _refresh(self):
+        redditor = reddit_client().redditor(bot_username())
+        comments = list(redditor.comments.new(limit=self.limit))
+        # only top-level comments are analyses; !annotate image replies and
+        # error replies sit under other comments
+        self._post_ids = {
+            c.link_id.split("_", 1)[-1] for c in comments if c.parent_id == c.link_id
+        }
+        self._oldest = min((c.created_utc for c in comments), default=None)
+        self._complete = len(comments) < self.limit
+
+    def add(self, post_id):
+        with self._lock:
+            if self._post_ids is not None:
+                self._post_ids.add(post_id)
+
+    def lookup(self, post, refresh=False):
+        # None when the post is older than anything the listing reaches back
+        # to, so the listing can't tell either way.
+        with self._lock:
+            if refresh or self._post_ids is None:
+                self._refresh()
+            if post.id in self._post_ids:
+                return True
+            if self._complete or (
+                self._oldest is not None and post.created_utc >= self._oldest
+            ):
+                return False
+            return None
 
-                if any(
-                    c.author and c.author.name.lower() == reddit.user.me().name.lower()
-                    for c in post.comments
-                ):
-                    print("Already analyzed")
-                    continue
 
-                convo_text = get_convo_str(msgs)
-                embedding = get_embedding(convo_text)
+bot_comments = BotCommentIndex()
 
-                similar_conversations = find_similar_conversations(embedding, post.id)
-                if similar_conversations:
-                    print("Similar conversations found:")
-                    for i, (post_id, score, convo_text) in enumerate(
-                        similar_conversations, start=1
-                    ):
-                        print(f"#{i}: post:{post_id} (score {score:.2f})")
-                        print(convo_text[:100])
 
-                for attempt in range(2):
-                    try:
-                        post_comment_image(
-                            post.id,
-                            out_path,
-                            msgs,
-                            (
-                                None
-                                if color_data_left is None
-                                else color_data_left["label"]
-                            ),
-                            (
-                                None
-                                if color_data_right is None
-                                else color_data_right["label"]
-                            ),
-                            elo_left,
-                            elo_right,
-                            data["opening"],
-                            similar_conversations,
-                            data.get("evaluation"),
-                            None,
-                            data["coach_insight"],
-                        )
-                        break
-                    except Exception as e:
-                        print(
-                            f"Post comment image attempt {attempt + 1} failed due to unexpected error: {e}"
-                        )
-                        time.sleep(15)
+def already_analyzed(post, refresh=False):
+    analyzed = bot_comments.lookup(post, refresh=refresh)
+    if analyzed is None:
+        try:
+            analyzed = get_post_json_from_kv(post.id) is not None
+        except Exception as e:
+            print(f"[!] KV lookup failed for {post.id}, checking comments: {e}")
+            analyzed = any(
+                c.author and c.author.name.lower() == bot_username()
+                for c in post.comments
+            )
+    return analyzed
+
+
+def analyze_post(post, workdir) -> tuple[str, PostAnalysis | None]:
+    with embedding_batcher.expecting():
+        return _analyze_post(post, workdir)
+
+
+def _analyze_post(post, workdir) -> tuple[str, PostAnalysis | None]:
+    print(f"Looking at post {post.id}")
+    # if post.id != "1k40vss":
+    #     return None
+
+    image_urls = extract_image_urls(post)
 
-                store_post_analysis_json(post.id, data)
-                pinecone_insert(post.id, embedding, convo_text)
+    if not image_urls:
+        print(f"No images found for {post.id}")
+        return "no_images", None
 
-                # img_url = upload_image_to_imgur(out_path)
-                # print("Successfully uploaded to imgur")
+    os.makedirs(workdir, exist_ok=True)
+    input_paths = download_images(image_urls, workdir)
 
-                # breakdown = format_counts(msgs, None if color_data_left is None else color_data_left["label"], None if color_data_right is None else color_data_right["label"], elo_left, elo_right)
-                # reply = f"**Game Review**\n\n{breakdown}\n\n[**Annotated Analysis**]({img_url})\n\n&nbsp;\n\n[*What do the classifications mean?*](https://support.chess.com/en/articles/8584089-how-does-game-review-work#h_49f5656333)"
-                # post.reply(reply)
-                # print(f"Commented on post {post.id}")
+    # stitched = os.path.join(workdir, "stitched.jpg")
+    out_path = os.path.join(workdir, "out.jpg")
+    # stitch_images_vertically(input_paths, stitched)
+    data = None
+    try:
+        fingerprints = [image_fingerprint(path) for path in input_paths]
+        repost_of = find_repost(post.id, fingerprints)
+    except Exception as e:
+        print(f"[!] Could not fingerprint images for {post.id}: {e}")
+        fingerprints, repost_of = None, None
+    if repost_of is not None:
+        # without the original's analysis this is analyzed like any new post
+        try:
+            data = get_post_json_from_kv(repost_of)
+        except Exception as e:
+            print(f"[!] Could not load analysis of {repost_of} for {post.id}: {e}")
+        if data is not None:
+            print(f"{post.id} reposts {repost_of}, reusing its analysis")
+
+    if data is None:
+        print(f"Analyzing post {post.id} with title: {post.title}")
+    for attempt in range(2 if data is None else 0):
+        try:
+            data = call_llm_on_image(input_paths, post.title, post.selftext)
+            break
+        except Exception as e:
+            print(
+                f"Call llm attempt {attempt + 1} for {post.id} failed due to unexpected error: {e}"
+            )
+            time.sleep(15)
+
+    if data is None:
+        print(f"[!] Giving up on {post.id}")
+        return "llm_failed", None
+
+    if data.get("is_convo") is False:
+        print(f"{post.id} is not a conversation, skipping")
+        return "not_convo", None
+
+    # only conversations are worth matching reposts against
+    if fingerprints:
+        try:
+            record_image_fingerprints(post.id, fingerprints)
+        except Exception as e:
+            print(f"[!] Could not record image fingerprints for {post.id}: {e}")
+
+    color_data_left, color_data_right = data["color"].get("left"), data["color"].get(
+        "right"
+    )
+    msgs = parse_llm_response(data)
+    print(f"Parsed LLM response for {post.id}")
+    render_conversation(
+        msgs,
+        color_data_left,
+        color_data_right,
+        data["color"]["background_hex"],
+        out_path,
+        # the sweep renders each post once; only the text runs are worth
+        # keeping for later !annotate renders
+        cache_key=post.id,
+        cache_base=False,
+    )
+    print(f"Rendered analysis image for {post.id}")
+
+    convo_text = get_convo_str(msgs)
+    embedding = embedding_batcher.embed(convo_text)
+    return "analyzed", PostAnalysis(
+        post=post,
+        data=data,
+        msgs=msgs,
+        out_path=out_path,
+        convo_text=convo_text,
+        embedding=embedding,
+        similar_conversations=find_similar_conversations(embedding, post.id),
+    )
+
+
+def drop_deleted_conversations(analyses: list[PostAnalysis], max=3):
+    # one reddit.info call for every candidate in the batch; also warms
+    # post_title() for publishing
+    posts = fetch_posts(
+        similar_id
+        for analysis in analyses
+        for similar_id, _, _ in analysis.similar_conversations
+    )
+    for analysis in analyses:
+        post = analysis.post
+        analysis.similar_conversations = [
+            similar
+            for similar in analysis.similar_conversations
+            if not submission_is_deleted(posts[similar[0]])
+        ][:max]
+        if analysis.similar_conversations:
+            print(f"Similar conversations found for {post.id}:")
+            for i, (similar_id, score, similar_text) in enumerate(
+                analysis.similar_conversations, start=1
+            ):
+                print(f"#{i}: post:{similar_id} (score {score:.2f})")
+                print(similar_text[:100])
+
+
+def publish_analysis(analysis: PostAnalysis, backend: CommentBackend) -> str:
+    post, data, msgs = analysis.post, analysis.data, analysis.msgs
+
+    # another run may have commented while this one was calling the LLM
+    if already_analyzed(post, refresh=True):
+        print(f"Already analyzed {post.id}")
+        return "already_analyzed"
+
+    elo_left, elo_right = data["elo"].get("left"), data["elo"].get("right")
+    color_data_left, color_data_right = data["color"].get("left"), data["color"].get(
+        "right"
+    )
+    outcome = "post_failed"
+    for attempt in range(2):
+        try:
+            backend.post_analysis(
+                post.id,
+                analysis.out_path,
+                msgs,
+                (None if color_data_left is None else color_data_left["label"]),
+                (None if color_data_right is None else color_data_right["label"]),
+                elo_left,
+                elo_right,
+                data["opening"],
+                analysis.similar_conversations,
+                data.get("evaluation"),
+                None,
+                data["coach_insight"],
+            )
+            bot_comments.add(post.id)
+            outcome = "posted"
+            break
+        except Exception as e:
+            print(
+                f"Post comment image attempt {attempt + 1} failed due to unexpected error: {e}"
+            )
+            backend.reset()
+            time.sleep(15)
+
+    # already_analyzed reads an existing post: key as "the bot commented", so
+    # it's only written once the comment is up and a failed post gets retried
+    if outcome == "posted":
+        store_post_analysis_json(post.id, data)
+    try:
+        vector_insert(post.id, analysis.embedding, analysis.convo_text)
+    except Exception as e:
+        print(f"[!] Could not store vector for {post.id}: {e}")
+    return outcome
+
+    # img_url = upload_image_to_imgur(out_path)
+    # print("Successfully uploaded to imgur")
+
+    # breakdown = format_counts(msgs, None if color_data_left is None else color_data_left["label"], None if color_data_right is None else color_data_right["label"], elo_left, elo_right)
+    # reply = f"**Game Review**\n\n{breakdown}\n\n[**Annotated Analysis**]({img_url})\n\n&nbsp;\n\n[*What do the classifications mean?*](https://support.chess.com/en/articles/8584089-how-does-game-review-work#h_49f5656333)"
+    # post.reply(reply)
+    # print(f"Commented on post {post.id}")
+
+
+def handle_new_posts(post_id=None, max_workers=ANALYZE_WORKERS):
+    # for post in get_recent_posts():
+    # for post in get_top_posts():
+    if post_id is None:
+        posts = get_recent_posts()
+    else:
+        posts = [get_post_by_id(post_id)]
+
+    # an explicitly requested post is always looked at again
+    content_hashes = {post.id: post_content_hash(post) for post in posts}
+    if post_id is None:
+        skipped = [p for p in posts if already_processed(p, content_hashes[p.id])]
+        for post in skipped:
+            print(f"Skipping {post.id}, already in ledger")
+        posts = [p for p in posts if p not in skipped]
+
+    analyzed = [p for p in posts if already_analyzed(p)]
+    for post in analyzed:
+        print(f"Already analyzed {post.id}")
+        record_outcome(post.id, "already_analyzed", content_hashes[post.id])
+    posts = [p for p in posts if p not in analyzed]
+
+    # Downloading, the LLM call, embedding and the vector query run on the
+    # worker pool. praw isn't thread-safe, so Reddit reads and posting stay on
+    # this thread, which also sends comments out one at a time.
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir, ThreadPoolExecutor(
+            max_workers=max(1, max_workers)
+        ) as pool, comment_backend() as backend:
+            futures = {
+                pool.submit(analyze_post, post, os.path.join(tmpdir, post.id)): post
+                for post in posts
+            }
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                analyses = []
+                for future in done:
+                    post = futures[future]
+                    try:
+                        outcome, analysis = future.result()
+                    except Exception as e:
+                        print(f"[!] Failed to analyze post {post.id}: {e}")
+                        record_outcome(post.id, "error", content_hashes[post.id])
+                        continue
+                    if analysis is None:
+                        record_outcome(post.id, outcome, content_hashes[post.id])
+                    else:
+                        analyses.append(analysis)
+                if not analyses:
+                    continue
+
+                try:
+                    drop_deleted_conversations(analyses)
+                except Exception as e:
+                    print(f"[!] Could not check similar posts, leaving them out: {e}")
+                    for analysis in analyses:
+                        analysis.similar_conversations = []
+                for analysis in analyses:
+                    post = analysis.post
+                    outcome = publish_analysis(analysis, backend)
+                    record_outcome(post.id, outcome, content_hashes[post.id])
+                # the comments advertise !annotate, which needs the post: keys;
+                # one bulk write covers everything this batch posted
+                flush_kv()
+    finally:
+        kv_client().flush()
     print("Ran successfully")
     return "Done", 200
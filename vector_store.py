@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class VectorMatch:
+    id: str
+    score: float
+    convo_text: str
+
+
+class VectorStore(ABC):
+    # Similarity search over conversation embeddings, scored by cosine
+    # similarity like the hosted Pinecone index.
+    @abstractmethod
+    def upsert(self, post_id: str, embedding, convo_text: str):
+        pass
+
+    @abstractmethod
+    def query(self, embedding, top_k: int) -> list[VectorMatch]:
+        pass
+
+
+class PineconeStore(VectorStore):
+    def __init__(self, api_key: str, index_name: str = "texting-theory"):
+        self.api_key = api_key
+        self.index_name = index_name
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def index(self):
+        with self._lock:
+            if self._index is None:
+                from pinecone import Pinecone
+
+                self._index = Pinecone(api_key=self.api_key).Index(self.index_name)
+            return self._index
+
+    def upsert(self, post_id, embedding, convo_text):
+        vector = {
+            "id": post_id,
+            "values": embedding,
+            "metadata": {"convo_text": convo_text},
+        }
+        self.index.upsert(vectors=[vector])
+
+    def query(self, embedding, top_k):
+        result = self.index.query(vector=embedding, top_k=top_k, include_metadata=True)
+        return [
+            VectorMatch(match.id, match.score, match.metadata["convo_text"])
+            for match in result.matches
+        ]
+
+
+class LocalVectorStore(VectorStore):
+    # Vectors are unit-normalised float32 rows appended to vectors.f32 and read
+    # back through a memmap; items.jsonl holds the id and convo_text of each
+    # row. Re-upserting an id appends a new row that supersedes the old one.
+    #
+    # Below IVF_MIN_VECTORS every query is an exact scan. Past it, an IVF
+    # index (spherical k-means centroids + per-row list assignment) is built
+    # and queries only score rows in the IVF_PROBES closest lists, plus any
+    # rows added since the last build. The index is rebuilt once the store
+    # has grown by IVF_REBUILD_GROWTH.
+    IVF_MIN_VECTORS = 4096
+    IVF_PROBES = 8
+    IVF_REBUILD_GROWTH = 2.0
+    KMEANS_ITERATIONS = 10
+
+    def __init__(self, path: str):
+        self.path = path
+        self._vectors_file = os.path.join(path, "vectors.f32")
+        self._items_file = os.path.join(path, "items.jsonl")
+        self._meta_file = os.path.join(path, "meta.json")
+        self._ivf_file = os.path.join(path, "ivf.npz")
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        self.dim = None
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+        self._items = []
+        lines = 0
+        if os.path.exists(self._items_file):
+            with open(self._items_file, encoding="utf-8") as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        self._items.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break  # torn final line from an interrupted append
+
+        # an interrupted upsert can leave either file a row ahead; cut both
+        # back to the rows they agree on so later appends stay aligned
+        rows = 0
+        if self.dim is not None and os.path.exists(self._vectors_file):
+            row_bytes = 4 * self.dim
+            size = os.path.getsize(self._vectors_file)
+            rows = min(size // row_bytes, len(self._items))
+            if size != rows * row_bytes:
+                os.truncate(self._vectors_file, rows * row_bytes)
+        self._items = self._items[:rows]
+        if lines != rows:
+            with open(self._items_file, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(item) + "\n" for item in self._items)
+        self._latest = {item["id"]: row for row, item in enumerate(self._items)}
+        self._live = np.zeros(rows, dtype=bool)
+        self._live[list(self._latest.values())] = True
+        self._vectors = None
+
+        self._centroids = None
+        self._lists = None
+        self._ivf_rows = 0
+        if os.path.exists(self._ivf_file):
+            ivf = np.load(self._ivf_file)
+            if int(ivf["rows"]) <= len(self._items):
+                self._centroids = ivf["centroids"]
+                self._lists = ivf["lists"]
+                self._ivf_rows = int(ivf["rows"])
+
+    def __len__(self):
+        return len(self._latest)
+
+    def _matrix(self):
+        if self._vectors is None or len(self._vectors) != len(self._items):
+            if not self._items:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            self._vectors = np.memmap(
+                self._vectors_file,
+                dtype=np.float32,
+                mode="r",
+                shape=(len(self._items), self.dim),
+            )
+        return self._vectors
+
+    @staticmethod
+    def _normalise(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def upsert(self, post_id, embedding, convo_text):
+        vector = self._normalise(embedding)
+        with self._lock:
+            if self.dim is None:
+                self.dim = len(vector)
+                with open(self._meta_file, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            elif len(vector) != self.dim:
+                raise ValueError(f"Expected {self.dim} dimensions, got {len(vector)}")
+
+            with open(self._vectors_file, "ab") as f:
+                f.write(vector.tobytes())
+            with open(self._items_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"id": post_id, "convo_text": convo_text}) + "\n")
+            self._items.append({"id": post_id, "convo_text": convo_text})
+            superseded = self._latest.get(post_id)
+            if superseded is not None:
+                self._live[superseded] = False
+            self._live = np.append(self._live, True)
+            self._latest[post_id] = len(self._items) - 1
+
+            rows = len(self._items)
+            if rows >= self.IVF_MIN_VECTORS and (
+                self._centroids is None
+                or rows >= self._ivf_rows * self.IVF_REBUILD_GROWTH
+            ):
+                self._build_ivf()
+
+    def _build_ivf(self):
+        vectors = np.asarray(self._matrix())
+        rows = len(vectors)
+        nlist = max(1, int(np.sqrt(rows)))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(rows, nlist, replace=False)].copy()
+        for _ in range(self.KMEANS_ITERATIONS):
+            lists = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(nlist):
+                members = vectors[lists == i]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    centroids[i] = centroid / (np.linalg.norm(centroid) or 1.0)
+        lists = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+        tmp = self._ivf_file + ".tmp.npz"
+        np.savez(tmp, centroids=centroids, lists=lists, rows=np.int64(rows))
+        os.replace(tmp, self._ivf_file)
+        self._centroids, self._lists, self._ivf_rows = centroids, lists, rows
+        print(f"Built IVF index over {rows} vectors ({nlist} lists)")
+
+    def _candidate_rows(self, vector):
+        rows = len(self._items)
+        if self._centroids is None:
+            return np.arange(rows)
+        probes = min(self.IVF_PROBES, len(self._centroids))
+        nearest = np.argpartition(-(self._centroids @ vector), probes - 1)[:probes]
+        indexed = np.flatnonzero(np.isin(self._lists, nearest))
+        return np.concatenate([indexed, np.arange(self._ivf_rows, rows)])
+
+    def query(self, embedding, top_k):
+        vector = self._normalise(embedding)
+        with self._lock:
+            if not self._items:
+                return []
+            candidates = self._candidate_rows(vector)
+            # drop rows superseded by a later upsert of the same id
+            candidates = candidates[self._live[candidates]]
+            if not len(candidates):
+                return []
+            scores = self._matrix()[candidates] @ vector
+            k = min(top_k, len(candidates))
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                VectorMatch(
+                    self._items[candidates[i]]["id"],
+                    float(scores[i]),
+                    self._items[candidates[i]]["convo_text"],
+                )
+                for i in best
+            ]